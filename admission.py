@@ -0,0 +1,161 @@
+import asyncio
+import itertools
+import logging
+import os
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.types import Update
+
+from db import DB_POOL_SIZE
+from metrics import ADMISSION_SHED
+
+# Обработчиков одновременно: по умолчанию — постоянные соединения пула БД, чтобы
+# всплеск апдейтов не занимал весь пул: временные соединения остаются фоновым задачам
+ADMISSION_CONCURRENCY = int(os.getenv("ADMISSION_CONCURRENCY", str(DB_POOL_SIZE)))
+ADMISSION_USER_DEPTH = int(os.getenv("ADMISSION_USER_DEPTH", "8"))  # апдейтов одного пользователя в очереди
+ADMISSION_QUEUE_LIMIT = int(os.getenv("ADMISSION_QUEUE_LIMIT", "5000"))  # всего принятых и не обработанных
+
+SUPERSEDED = "superseded"
+USER_DEPTH = "user_depth"
+OVERLOAD = "overload"
+
+logger = logging.getLogger(__name__)
+
+
+class Ticket:
+    __slots__ = ("user_id", "kind", "number", "done")
+
+    def __init__(self, user_id: int, kind: str | None, number: int):
+        self.user_id = user_id
+        self.kind = kind
+        self.number = number
+        self.done = False
+
+
+class _UserState:
+    __slots__ = ("lock", "depth", "latest")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.depth = 0
+        # kind -> номер последнего принятого апдейта этого вида
+        self.latest: dict[str, int] = {}
+
+
+class AdmissionControl:
+    # Апдейты одного пользователя обрабатываются по очереди, всех вместе — не больше
+    # concurrency одновременно. Апдейт с видом (kind) — абсолютная установка значения:
+    # если за ним в очереди уже стоит апдейт того же вида, он не выполняется.
+
+    def __init__(self, concurrency: int = ADMISSION_CONCURRENCY, user_depth: int = ADMISSION_USER_DEPTH,
+                 queue_limit: int = ADMISSION_QUEUE_LIMIT):
+        self.user_depth = user_depth
+        self.queue_limit = queue_limit
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._users: dict[int, _UserState] = {}
+        self._numbers = itertools.count(1)
+        self.pending = 0
+        self.in_flight = 0
+
+    def admit(self, user_id: int, kind: str | None) -> Ticket | str:
+        # -> билет или причина отказа
+        state = self._users.get(user_id)
+        if state is not None and state.depth >= self.user_depth:
+            return USER_DEPTH
+        if self.pending >= self.queue_limit:
+            return OVERLOAD
+        if state is None:
+            state = self._users[user_id] = _UserState()
+        ticket = Ticket(user_id, kind, next(self._numbers))
+        state.depth += 1
+        if kind is not None:
+            state.latest[kind] = ticket.number
+        self.pending += 1
+        return ticket
+
+    def release(self, ticket: Ticket):
+        if ticket.done:
+            return
+        ticket.done = True
+        self.pending -= 1
+        state = self._users[ticket.user_id]
+        state.depth -= 1
+        if state.depth == 0:
+            del self._users[ticket.user_id]
+
+    def waiting(self) -> int:
+        return self.pending - self.in_flight
+
+    async def run(self, ticket: Ticket, call, on_superseded=None):
+        try:
+            async with self._users[ticket.user_id].lock:
+                if ticket.kind is not None and self._users[ticket.user_id].latest[ticket.kind] != ticket.number:
+                    ADMISSION_SHED.labels(SUPERSEDED).inc()
+                    if on_superseded is not None:
+                        await on_superseded()
+                    return None
+                async with self._semaphore:
+                    self.in_flight += 1
+                    try:
+                        return await call()
+                    finally:
+                        self.in_flight -= 1
+        finally:
+            self.release(ticket)
+
+
+class AdmissionMiddleware(BaseMiddleware):
+    # Внешний middleware на апдейт: выдаёт билет или сразу отказывает при перегрузке.
+    # Сам запуск обработчика ограничивает AdmissionSlotMiddleware внутри цепочки.
+
+    def __init__(self, control: AdmissionControl, classify):
+        # classify(update) -> вид абсолютного изменения ("amount", "base") или None
+        self.control = control
+        self.classify = classify
+
+    async def __call__(self, handler, event: Update, data: dict):
+        user = data.get("event_from_user")
+        if user is None or (event.message is None and event.callback_query is None):
+            return await handler(event, data)
+
+        ticket = self.control.admit(user.id, self.classify(event))
+        if not isinstance(ticket, Ticket):
+            ADMISSION_SHED.labels(ticket).inc()
+            if event.callback_query is not None:
+                await _answer_busy(event.callback_query)
+            return None
+
+        data["admission_ticket"] = ticket
+        try:
+            result = await handler(event, data)
+        except BaseException:
+            self.control.release(ticket)
+            raise
+        if result is UNHANDLED:
+            self.control.release(ticket)
+        return result
+
+
+class AdmissionSlotMiddleware(BaseMiddleware):
+    # Внутренний middleware: ждёт очереди пользователя и общего слота.
+    # У нажатий кнопок работает уже в фоновой задаче, после ответа Telegram.
+
+    def __init__(self, control: AdmissionControl, on_superseded=None):
+        # on_superseded(event) — что сделать с пропущенным апдейтом (например, удалить сообщение)
+        self.control = control
+        self.on_superseded = on_superseded
+
+    async def __call__(self, handler, event, data: dict):
+        ticket = data.get("admission_ticket")
+        if ticket is None:
+            return await handler(event, data)
+        on_superseded = (lambda: self.on_superseded(event)) if self.on_superseded else None
+        return await self.control.run(ticket, lambda: handler(event, data), on_superseded)
+
+
+async def _answer_busy(callback):
+    try:
+        await callback.answer("⏳ Слишком много нажатий, повторите чуть позже")
+    except Exception as e:
+        logger.debug("Не удалось ответить на callback %s: %r", callback.id, e)
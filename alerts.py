@@ -0,0 +1,183 @@
+import asyncio
+import html
+import logging
+import os
+import re
+from bisect import bisect_left, bisect_right, insort
+from dataclasses import dataclass
+
+from ratelimit import TokenBucket
+from sender import sender, BACKGROUND
+
+ALERTS_PER_USER = int(os.getenv("ALERTS_PER_USER", "20"))
+ALERT_QUEUE_SIZE = int(os.getenv("ALERT_QUEUE_SIZE", "1000"))
+ALERT_SEND_RATE = float(os.getenv("ALERT_SEND_RATE", "10"))  # уведомлений в секунду: остаток лимита — интерактиву
+ALERT_WORKERS = int(os.getenv("ALERT_WORKERS", "4"))
+
+ABOVE = ">"
+BELOW = "<"
+
+# /alert USD > 100 [RUB]
+ALERT_PATTERN = re.compile(r"^([A-Za-z]{3})\s*([<>])\s*(\d+(?:[.,]\d+)?)\s*([A-Za-z]{3})?$")
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Alert:
+    id: int
+    user_id: int
+    chat_id: int
+    currency: str
+    quote: str
+    direction: str
+    threshold: float
+
+    @property
+    def pair(self) -> tuple[str, str]:
+        return self.currency, self.quote
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Alert":
+        return cls(**{key: data[key] for key in cls.__dataclass_fields__})
+
+
+def parse_alert(text: str | None) -> tuple[str, str, float, str] | None:
+    match = ALERT_PATTERN.match((text or "").strip())
+    if match is None:
+        return None
+    currency, direction, threshold, quote = match.groups()
+    return currency.upper(), direction, float(threshold.replace(",", ".")), (quote or "RUB").upper()
+
+
+def is_triggered(direction: str, rate: float, threshold: float) -> bool:
+    return rate > threshold if direction == ABOVE else rate < threshold
+
+
+class AlertIndex:
+    # Пороги по каждой паре валют лежат в отсортированных списках (threshold, id):
+    # отдельно «выше» и «ниже». Новый снимок сдвигает курс пары со старого значения
+    # на новое, и сработавшие уведомления — ровно срез списка между ними.
+
+    def __init__(self):
+        self._alerts: dict[int, Alert] = {}
+        self._by_user: dict[int, set[int]] = {}
+        self._above: dict[tuple, list[tuple[float, int]]] = {}
+        self._below: dict[tuple, list[tuple[float, int]]] = {}
+        # Курс пары на момент последней проверки; None — ещё не проверяли
+        self._last_rates: dict[tuple, float] = {}
+
+    def __len__(self) -> int:
+        return len(self._alerts)
+
+    def _side(self, direction: str) -> dict:
+        return self._above if direction == ABOVE else self._below
+
+    def add(self, alert: Alert, current_rate: float | None = None):
+        self._alerts[alert.id] = alert
+        self._by_user.setdefault(alert.user_id, set()).add(alert.id)
+        insort(self._side(alert.direction).setdefault(alert.pair, []), (alert.threshold, alert.id))
+        if current_rate is not None:
+            self._last_rates.setdefault(alert.pair, current_rate)
+
+    def remove(self, alert_id: int) -> Alert | None:
+        alert = self._alerts.pop(alert_id, None)
+        if alert is None:
+            return None
+        self._forget(alert)
+        entries = self._side(alert.direction)[alert.pair]
+        position = bisect_left(entries, (alert.threshold, alert.id))
+        del entries[position]
+        return alert
+
+    def _forget(self, alert: Alert):
+        user_alerts = self._by_user[alert.user_id]
+        user_alerts.discard(alert.id)
+        if not user_alerts:
+            del self._by_user[alert.user_id]
+
+    def user_alerts(self, user_id: int) -> list[Alert]:
+        return sorted((self._alerts[alert_id] for alert_id in self._by_user.get(user_id, ())), key=lambda a: a.id)
+
+    def evaluate(self, snapshot) -> list[tuple[Alert, float]]:
+        # Возвращает сработавшие уведомления с новым курсом и сразу убирает их из индекса
+        fired = []
+        for pair in set(self._above) | set(self._below):
+            currency, quote = pair
+            if currency not in snapshot.index or quote not in snapshot.index:
+                continue
+            new = snapshot.cross_rate(currency, quote)
+            old = self._last_rates.get(pair)
+            self._last_rates[pair] = new
+
+            # «выше»: old <= threshold < new
+            above = self._above.get(pair)
+            if above and (old is None or new > old):
+                low = 0 if old is None else bisect_left(above, old, key=lambda entry: entry[0])
+                high = bisect_left(above, new, key=lambda entry: entry[0])
+                fired += [(self._alerts.pop(alert_id), new) for _, alert_id in above[low:high]]
+                del above[low:high]
+
+            # «ниже»: new < threshold <= old
+            below = self._below.get(pair)
+            if below and (old is None or new < old):
+                low = bisect_right(below, new, key=lambda entry: entry[0])
+                high = len(below) if old is None else bisect_right(below, old, key=lambda entry: entry[0])
+                fired += [(self._alerts.pop(alert_id), new) for _, alert_id in below[low:high]]
+                del below[low:high]
+
+        for alert, _ in fired:
+            self._forget(alert)
+        return fired
+
+
+def format_alert(alert: Alert) -> str:
+    # Сообщения уходят с parse_mode=HTML, поэтому < и > экранируются
+    return html.escape(f"{alert.currency} {alert.direction} {alert.threshold:g} {alert.quote}")
+
+
+class AlertNotifier:
+    # Доставка сработавших уведомлений: ограниченная очередь (при всплеске
+    # submit ждёт), собственный лимит скорости и фоновый приоритет в sender.
+
+    def __init__(self, maxsize: int = ALERT_QUEUE_SIZE, rate: float = ALERT_SEND_RATE, workers: int = ALERT_WORKERS):
+        self.maxsize = maxsize
+        self.workers = workers
+        self._bucket = TokenBucket(rate)
+        self._queue: asyncio.Queue | None = None
+        self._tasks: list[asyncio.Task] = []
+        self.stats = {"sent": 0, "failed": 0}
+
+    def start(self):
+        self._queue = asyncio.Queue(self.maxsize)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, alert: Alert, rate: float):
+        await self._queue.put((alert, rate))
+
+    async def _worker(self):
+        while True:
+            alert, rate = await self._queue.get()
+            try:
+                await self._bucket.acquire()
+                await sender.send_message(
+                    chat_id=alert.chat_id,
+                    text=f"🔔 {format_alert(alert)}\nСейчас 1 {alert.currency} = {rate:.4f} {alert.quote}",
+                    priority=BACKGROUND,
+                )
+                self.stats["sent"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.warning("Не удалось отправить уведомление %s пользователю %s: %r", alert.id, alert.user_id, e)
+            finally:
+                self._queue.task_done()
+
+
+alert_index = AlertIndex()
+alert_notifier = AlertNotifier()
@@ -0,0 +1,117 @@
+import asyncio
+import contextvars
+import logging
+import os
+from collections import deque
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery
+
+from metrics import BACKGROUND_ERRORS, start_tap
+
+BACKGROUND_CONCURRENCY = int(os.getenv("BACKGROUND_CONCURRENCY", "64"))
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedLanes:
+    # Очередь по ключам (user_id): элементы одного ключа обрабатываются строго
+    # по очереди, разных — параллельно. process(key, item) -> корутина.
+    # Исключения не останавливают очередь ключа: пишутся в лог и в счётчик failed.
+
+    def __init__(self, process):
+        self._process = process
+        self._lanes: dict = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.processed = 0
+        self.failed = 0
+
+    def submit(self, key, item):
+        lane = self._lanes.get(key)
+        if lane is not None:
+            lane.append(item)
+            return
+        lane = self._lanes[key] = deque([item])
+        task = asyncio.create_task(self._drain(key, lane))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, key, lane: deque):
+        try:
+            while lane:
+                try:
+                    await self._process(key, lane[0])
+                    self.processed += 1
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.failed += 1
+                    self._on_error(key, lane[0], e)
+                finally:
+                    lane.popleft()
+        finally:
+            del self._lanes[key]
+
+    def _on_error(self, key, item, error: Exception):
+        logger.exception("Ошибка обработки для %s", key)
+
+    def pending(self) -> int:
+        return sum(len(lane) for lane in self._lanes.values())
+
+    def active(self) -> int:
+        return len(self._lanes)
+
+    async def join(self):
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await self.join()
+
+
+class KeyedTaskQueue(KeyedLanes):
+    # Фоновые задачи по ключам: не больше concurrency одновременно по всем ключам.
+    # Ошибки дополнительно попадают в bot_background_errors_total.
+
+    def __init__(self, concurrency: int = BACKGROUND_CONCURRENCY):
+        super().__init__(self._run)
+        self.concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def submit(self, key, name: str, factory, context: contextvars.Context | None = None):
+        # factory() -> корутина; создаётся только перед запуском, в context (по умолчанию — копия текущего)
+        super().submit(key, (name, factory, contextvars.copy_context() if context is None else context))
+
+    async def _run(self, key, job: tuple):
+        _name, factory, context = job
+        async with self._semaphore:
+            # Своя задача в контексте отправителя: у каждого нажатия свои contextvars
+            await asyncio.create_task(factory(), context=context)
+
+    def _on_error(self, key, job: tuple, error: Exception):
+        BACKGROUND_ERRORS.labels(job[0], type(error).__name__).inc()
+        logger.exception("Фоновая задача %s для %s завершилась с ошибкой", job[0], key)
+
+
+class CallbackAckMiddleware(BaseMiddleware):
+    # Внутренний middleware на callback_query: сразу отвечает Telegram (у клиента
+    # пропадает «часики»), а сам обработчик ставит в очередь пользователя.
+
+    def __init__(self, queue: KeyedTaskQueue):
+        self.queue = queue
+
+    async def __call__(self, handler, event: CallbackQuery, data: dict):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        # Отметка нажатия — только в контексте задачи: в вызывающем контексте она
+        # досталась бы следующим апдейтам, которые обрабатываются в той же задаче
+        context = contextvars.copy_context()
+        context.run(start_tap, name)
+        try:
+            await event.answer()
+        except Exception as e:
+            # Запрос мог устареть; обработать нажатие всё равно нужно
+            logger.debug("Не удалось ответить на callback %s: %r", event.id, e)
+        self.queue.submit(event.from_user.id, name, lambda: handler(event, data), context)
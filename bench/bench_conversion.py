@@ -0,0 +1,58 @@
+# Пропускная способность конвертации: float (numpy) против Decimal, пакетно и через CSV.
+# Запуск: python bench/bench_conversion.py [--rows 2000000]
+import argparse
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_keyboards import make_snapshot  # noqa: E402
+from conversion import convert_batch, convert_batch_exact, convert_csv  # noqa: E402
+
+TARGETS = ["USD", "EUR", "CNY"]
+
+
+def make_rows(rows: int, codes: list[str], seed: int = 1) -> tuple[list[str], list[str]]:
+    rng = random.Random(seed)
+    amounts = [f"{rng.uniform(0, 100000):.2f}" for _ in range(rows)]
+    sources = [rng.choice(codes) for _ in range(rows)]
+    return amounts, sources
+
+
+def report(name: str, rows: int, seconds: float):
+    print(f"{name:<34} {rows / seconds / 1e6:8.2f} млн строк/с  ({seconds:6.2f} с)")
+
+
+def timed(func) -> float:
+    started = time.perf_counter()
+    func()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--csv-rows", type=int, default=500_000)
+    args = parser.parse_args()
+
+    snapshot = make_snapshot()
+    amounts, sources = make_rows(args.rows, snapshot.currencies)
+    floats = [float(amount) for amount in amounts]
+
+    report("float, суммы уже в памяти", args.rows, timed(lambda: convert_batch(snapshot, floats, sources, "RUB")))
+    report("Decimal, суммы уже в памяти", args.rows,
+           timed(lambda: convert_batch_exact(snapshot, amounts, sources, "RUB")))
+
+    lines = ["amount,currency"] + [f"{a},{s}" for a, s in zip(amounts[:args.csv_rows], sources)]
+    text = "\n".join(lines) + "\n"
+    for exact in (False, True):
+        sink = io.StringIO()
+        seconds = timed(lambda: convert_csv(snapshot, io.StringIO(text), sink, TARGETS, exact=exact))
+        report(f"CSV → {len(TARGETS)} валюты, {'Decimal' if exact else 'float'}", args.csv_rows, seconds)
+
+
+if __name__ == "__main__":
+    main()
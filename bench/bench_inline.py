@@ -0,0 +1,52 @@
+# Задержка inline-ответа: поток запросов «по нажатию клавиши» против снимка курсов в памяти.
+# Запуск: python bench/bench_inline.py
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_keyboards import make_snapshot  # noqa: E402
+from inline import build_inline_results, inline_results_cache, render_inline_results  # noqa: E402
+
+QUERIES = ["250 usd", "1000 eur", "99,5 cny", "5000", "usd 70", "12 thb", "€ 300", "1 gbp"]
+
+
+def keystrokes(query: str) -> list[str]:
+    # Клиент шлёт запрос на каждый набранный символ
+    return [query[:i] for i in range(1, len(query) + 1)]
+
+
+def percentiles(samples: list[float]) -> str:
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))] * 1e6  # noqa: E731
+    return f"p50 {pick(50):7.1f}  p99 {pick(99):7.1f}  max {pick(100):7.1f} мкс"
+
+
+def measure(name: str, func, stream: list, repeat: int = 1):
+    samples = []
+    for _ in range(repeat):
+        for item in stream:
+            started = time.perf_counter()
+            func(item)
+            samples.append(time.perf_counter() - started)
+    print(f"{name:<34} {percentiles(samples)}")
+
+
+def main():
+    snapshot = make_snapshot()
+    settings = {"selected": ["USD", "EUR", "CNY", "THB", "KZT", "RUB"], "base": "USD"}
+    targets = ("EUR", "CNY", "THB", "KZT", "RUB")
+    stream = [text for query in QUERIES for text in keystrokes(query)]
+    random.Random(1).shuffle(stream)
+
+    measure("render (без кэша)", lambda text: render_inline_results(snapshot, 250.0, "USD", targets), stream)
+    inline_results_cache.clear()
+    measure("первое нажатие (промах кэша)", lambda text: build_inline_results(text, settings, snapshot), stream)
+    measure("повтор (попадание в кэш)", lambda text: build_inline_results(text, settings, snapshot), stream, 50)
+    measure("без настроек в кэше", lambda text: build_inline_results(text, None, snapshot), stream, 50)
+
+
+if __name__ == "__main__":
+    main()
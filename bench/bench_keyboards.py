@@ -0,0 +1,118 @@
+# Микробенчмарк отрисовки клавиатур: без кэша и с кэшем.
+# Запуск: python bench/bench_keyboards.py
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram.utils.keyboard import InlineKeyboardBuilder  # noqa: E402
+
+from keyboards import (  # noqa: E402
+    build_currency_keyboard, build_rates_keyboard, get_flag_by_currency, render_currency_keyboard,
+    render_rates_keyboard,
+)
+from rates import RateSnapshot  # noqa: E402
+
+CODES = [
+    "AUD", "AZN", "GBP", "AMD", "BYN", "BGN", "BRL", "HUF", "VND", "HKD", "GEL", "DKK", "AED", "USD",
+    "EUR", "EGP", "INR", "IDR", "KZT", "CAD", "QAR", "KGS", "CNY", "MDL", "NZD", "NOK", "PLN", "RON",
+    "XDR", "SGD", "TJS", "THB", "TRY", "TMT", "UZS", "UAH", "CZK", "SEK", "CHF", "RSD", "ZAR", "KRW", "JPY",
+]
+
+
+def make_snapshot() -> RateSnapshot:
+    data = {"Valute": {code: {"Value": 10.0 + i * 3.7, "Nominal": 1 if i % 5 else 100} for i, code in enumerate(CODES)}}
+    return RateSnapshot.from_cbr(data, version=1)
+
+
+# Исходная отрисовка через InlineKeyboardBuilder — точка отсчёта «до».
+# Тела как были в main.py, только без async: ввода-вывода в них не было
+
+
+def baseline_format_currency_text(code, value, target_column, is_base=False):
+    flag = get_flag_by_currency(code)
+    if flag:
+        code_with_flag = f"{flag} {code}"
+    else:
+        code_with_flag = code
+
+    value_part = f"{value:,.2f}".replace(",", " ")
+
+    spaces_needed = target_column - len(code_with_flag)
+    spaces_needed = max(spaces_needed, 1)
+
+    if is_base:
+        left_spaces = spaces_needed // 2
+        right_spaces = spaces_needed - left_spaces
+        spaces = " " * left_spaces + "⭐" + " " * right_spaces
+    else:
+        spaces = " " * spaces_needed
+
+    return f"{code_with_flag}{spaces}{value_part}"
+
+
+def baseline_rates_keyboard(selected_currencies, base_currency, rates, amount):
+    builder = InlineKeyboardBuilder()
+
+    values = {}
+    for currency in selected_currencies:
+        if currency == base_currency:
+            values[currency] = amount
+        else:
+            values[currency] = (rates[base_currency] / rates[currency]) * amount
+
+    max_value_length = max(len(f"{v:,.2f}".replace(",", " ")) for v in values.values())
+    target_column = 40 - max_value_length
+
+    for currency in selected_currencies:
+        value = values[currency]
+        text = baseline_format_currency_text(
+            code=currency,
+            value=value,
+            target_column=target_column,
+            is_base=(currency == base_currency)
+        )
+        builder.button(text=text, callback_data=f"base_{currency}")
+
+    builder.button(text="🔙 Изменить выбор валют", callback_data="back_to_selection")
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+def baseline_currency_keyboard(all_currencies, selected_currencies):
+    builder = InlineKeyboardBuilder()
+    for idx, currency in enumerate(all_currencies):
+        if currency in selected_currencies:
+            text = f"✅ {currency}"
+        else:
+            text = f"❌ {currency}"
+        builder.button(text=text, callback_data=f"select_{currency}")
+        if (idx + 1) % 4 == 0:
+            builder.adjust(4)
+
+    builder.button(text="➡️ Показать курсы", callback_data="show_rates")
+    builder.adjust(4)
+    return builder.as_markup()
+
+
+def bench(name: str, func, number: int):
+    seconds = min(timeit.repeat(func, number=number, repeat=3))
+    print(f"{name:<32} {seconds / number * 1e6:10.1f} мкс/вызов")
+
+
+def main():
+    snapshot = make_snapshot()
+    selected = ["USD", "EUR", "CNY", "THB", "KZT", "RUB"]
+    chosen = set(selected)
+
+    bench("currency keyboard (исходная)", lambda: baseline_currency_keyboard(snapshot.currencies, selected), 20)
+    bench("currency keyboard (без кэша)", lambda: render_currency_keyboard(snapshot.currencies, chosen), 100)
+    bench("currency keyboard (с кэшем)", lambda: build_currency_keyboard(snapshot.currencies, selected), 20000)
+    bench("rates keyboard (исходная)", lambda: baseline_rates_keyboard(selected, "USD", snapshot.rates, 1234.5), 200)
+    bench("rates keyboard (без кэша)", lambda: render_rates_keyboard(selected, "USD", snapshot, 1234.5), 500)
+    bench("rates keyboard (с кэшем)", lambda: build_rates_keyboard(selected, "USD", snapshot, 1234.5), 20000)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+# Пакетная конвертация сумм по снимку курсов, без ввода-вывода.
+# Быстрый режим — float64 и numpy; точный — Decimal для учёта, где важна каждая копейка.
+#
+# Запуск как CLI: python conversion.py --to USD,EUR < amounts.csv > converted.csv
+import argparse
+import asyncio
+import csv
+import logging
+import math
+import sys
+from decimal import ROUND_HALF_UP, Context, Decimal
+
+import numpy as np
+
+from rates import RateSnapshot, rates_cache
+
+CSV_CHUNK_ROWS = 8192  # строк в памяти за раз
+DEFAULT_QUANTUM = Decimal("0.01")
+# 34 значащие цифры, как у decimal128: промежуточные значения не округляются до quantize
+EXACT_CONTEXT = Context(prec=34, rounding=ROUND_HALF_UP)
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownCurrency(ValueError):
+    pass
+
+
+def _indices(snapshot: RateSnapshot, codes) -> np.ndarray:
+    # Код валюты или последовательность кодов -> номера строк/столбцов матрицы курсов
+    try:
+        if isinstance(codes, str):
+            return np.intp(snapshot.index[codes])
+        return np.fromiter((snapshot.index[code] for code in codes), dtype=np.intp)
+    except KeyError as e:
+        raise UnknownCurrency(f"Неизвестная валюта: {e.args[0]}") from None
+
+
+def convert_batch(snapshot: RateSnapshot, amounts, sources, targets) -> np.ndarray:
+    # Быстрый путь: i-я сумма из sources[i] в targets[i]. Вместо последовательности
+    # можно передать один код — он применится ко всем суммам
+    amounts = np.asarray(amounts, dtype=np.float64)
+    return amounts * snapshot.matrix[_indices(snapshot, sources), _indices(snapshot, targets)]
+
+
+def decimal_rate(snapshot: RateSnapshot, code: str) -> Decimal:
+    # Value / Nominal в Decimal. Value в ответе ЦБ — 4 знака после запятой, и repr
+    # разобранного из JSON float возвращает ровно эту запись. Частное Value / Nominal
+    # в float так не восстанавливается: 87.6433 / 100000 = 0.0008764329999999999
+    if code not in snapshot.rates:
+        raise UnknownCurrency(f"Неизвестная валюта: {code}")
+    value, nominal = snapshot.published.get(code, (snapshot.rates[code], 1))  # RUB — 1.0
+    return EXACT_CONTEXT.divide(Decimal(repr(value)), Decimal(nominal))
+
+
+def to_decimal(value) -> Decimal:
+    if isinstance(value, Decimal):
+        return value
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    return Decimal(str(value).strip().replace(",", "."))
+
+
+def convert_batch_exact(snapshot: RateSnapshot, amounts, sources, targets,
+                        quantum: Decimal | None = DEFAULT_QUANTUM, rounding: str = ROUND_HALF_UP) -> list[Decimal]:
+    # Точный режим: сумма × курс исходной / курс целевой, одно округление в конце.
+    # quantum=None — без округления (34 значащие цифры)
+    amounts = [to_decimal(amount) for amount in amounts]
+    sources = [sources] * len(amounts) if isinstance(sources, str) else list(sources)
+    targets = [targets] * len(amounts) if isinstance(targets, str) else list(targets)
+    if not len(amounts) == len(sources) == len(targets):
+        raise ValueError("amounts, sources и targets разной длины")
+
+    rates = {code: decimal_rate(snapshot, code) for code in set(sources) | set(targets)}
+
+    multiply, divide = EXACT_CONTEXT.multiply, EXACT_CONTEXT.divide
+    if quantum is None:
+        return [divide(multiply(amount, rates[source]), rates[target])
+                for amount, source, target in zip(amounts, sources, targets)]
+    return [divide(multiply(amount, rates[source]), rates[target]).quantize(quantum, rounding, EXACT_CONTEXT)
+            for amount, source, target in zip(amounts, sources, targets)]
+
+
+def _to_float(text: str) -> float:
+    return float(text.replace(",", "."))
+
+
+def _is_finite(amount) -> bool:
+    # У Decimal — свой is_finite: перевод в float падает на sNaN и даёт inf на 1e5000
+    return amount.is_finite() if isinstance(amount, Decimal) else math.isfinite(amount)
+
+
+def _exact_column(snapshot: RateSnapshot, amounts: list, sources: list, target: str, quantum: Decimal) -> list[str]:
+    try:
+        return [str(value) for value in convert_batch_exact(snapshot, amounts, sources, target, quantum)]
+    except ArithmeticError:
+        # Результат не укладывается в 34 знака с шагом quantum (например, 1e5000):
+        # считаем построчно, такие ячейки остаются пустыми
+        column = []
+        for amount, source in zip(amounts, sources):
+            try:
+                column.append(str(convert_batch_exact(snapshot, [amount], [source], target, quantum)[0]))
+            except ArithmeticError:
+                column.append("")
+        return column
+
+
+def _convert_rows(snapshot: RateSnapshot, rows: list, amount_column: int, source_column: int | None,
+                  default_source: str | None, targets: list[str], exact: bool, quantum: Decimal,
+                  stats: dict) -> list:
+    # Строки с нечитаемой суммой или неизвестной валютой остаются с пустыми столбцами
+    parse = to_decimal if exact else _to_float
+    index = snapshot.index
+    good, amounts, sources = [], [], []
+    for position, row in enumerate(rows):
+        try:
+            source = row[source_column].strip().upper() if source_column is not None else default_source
+            amount = parse(row[amount_column])
+        except (IndexError, ValueError, ArithmeticError):
+            continue
+        if source in index and _is_finite(amount):
+            good.append(position)
+            amounts.append(amount)
+            sources.append(source)
+    stats["rows"] += len(rows)
+    stats["skipped"] += len(rows) - len(good)
+    if not good:
+        for row in rows:
+            row.extend([""] * len(targets))
+        return rows
+
+    if exact:
+        columns = [_exact_column(snapshot, amounts, sources, target, quantum) for target in targets]
+    else:
+        digits = max(0, -quantum.as_tuple().exponent)
+        amounts = np.array(amounts)
+        columns = [[f"{value:.{digits}f}" for value in convert_batch(snapshot, amounts, sources, target).tolist()]
+                   for target in targets]
+
+    # Строки из csv.reader больше нигде не нужны — дописываем столбцы в них же
+    if len(good) == len(rows):
+        for row, values in zip(rows, zip(*columns)):
+            row.extend(values)
+        return rows
+    blank = [""] * len(targets)
+    filled = dict(zip(good, zip(*columns)))
+    for position, row in enumerate(rows):
+        row.extend(filled.get(position, blank))
+    return rows
+
+
+def convert_csv(snapshot: RateSnapshot, source, sink, targets: list[str], amount_column: str = "amount",
+                source_column: str | None = "currency", default_source: str | None = None, exact: bool = False,
+                quantum: Decimal = DEFAULT_QUANTUM, chunk_rows: int = CSV_CHUNK_ROWS) -> dict:
+    # Читает CSV с заголовком по chunk_rows строк и дописывает по столбцу на каждую целевую валюту
+    unknown = [code for code in targets if code not in snapshot.index]
+    if unknown:
+        raise UnknownCurrency(f"Неизвестная валюта: {', '.join(unknown)}")
+    reader = csv.reader(source)
+    writer = csv.writer(sink, lineterminator="\n")
+    header = next(reader, None)
+    if header is None:
+        return {"rows": 0, "skipped": 0}
+    if amount_column not in header:
+        raise ValueError(f"В CSV нет столбца {amount_column!r}")
+    amount_index = header.index(amount_column)
+    source_index = header.index(source_column) if source_column in header else None
+    if source_index is None and default_source is None:
+        raise ValueError(f"В CSV нет столбца {source_column!r}, укажите исходную валюту (--from)")
+    writer.writerow(header + targets)
+
+    stats = {"rows": 0, "skipped": 0}
+    chunk = []
+    for row in reader:
+        chunk.append(row)
+        if len(chunk) >= chunk_rows:
+            writer.writerows(_convert_rows(snapshot, chunk, amount_index, source_index, default_source,
+                                           targets, exact, quantum, stats))
+            chunk = []
+    if chunk:
+        writer.writerows(_convert_rows(snapshot, chunk, amount_index, source_index, default_source,
+                                       targets, exact, quantum, stats))
+    return stats
+
+
+async def _load_snapshot() -> RateSnapshot:
+    # Снимок с диска, если он есть, иначе — загрузка из источников бота
+    try:
+        snapshot = await rates_cache.get()
+        if snapshot.restored and snapshot.is_stale():
+            try:
+                snapshot = await rates_cache.refresh()
+            except Exception as e:
+                logger.warning("Не удалось обновить курсы, использую сохранённые от %s: %r", snapshot.date, e)
+        return snapshot
+    finally:
+        await rates_cache.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Конвертация сумм из CSV по курсам ЦБ")
+    parser.add_argument("--to", required=True, help="целевые валюты через запятую: USD,EUR")
+    parser.add_argument("--from", dest="default_source", help="исходная валюта, если в CSV нет столбца валюты")
+    parser.add_argument("--amount-column", default="amount")
+    parser.add_argument("--currency-column", default="currency")
+    parser.add_argument("--exact", action="store_true",
+                        help="Decimal вместо float: медленнее, но без ошибок двоичной арифметики")
+    parser.add_argument("--quantum", default=str(DEFAULT_QUANTUM), help="шаг округления результата")
+    parser.add_argument("--chunk-rows", type=int, default=CSV_CHUNK_ROWS)
+    parser.add_argument("input", nargs="?", help="файл CSV; по умолчанию stdin")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    targets = [code.strip().upper() for code in args.to.split(",") if code.strip()]
+    try:
+        quantum = Decimal(args.quantum)
+    except ArithmeticError:
+        parser.error(f"неверный шаг округления: {args.quantum}")
+    try:
+        snapshot = asyncio.run(_load_snapshot())
+    except Exception as e:
+        parser.exit(1, f"Не удалось получить курсы ЦБ: {e}\n")
+    source = open(args.input, newline="", encoding="utf-8") if args.input else sys.stdin
+    try:
+        stats = convert_csv(
+            snapshot, source, sys.stdout, targets, args.amount_column, args.currency_column,
+            args.default_source.upper() if args.default_source else None, args.exact,
+            quantum, args.chunk_rows,
+        )
+    except ValueError as e:
+        parser.exit(2, f"{e}\n")
+    finally:
+        if source is not sys.stdin:
+            source.close()
+    print(f"Курсы ЦБ на {snapshot.date}: строк {stats['rows']}, пропущено {stats['skipped']}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
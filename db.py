@@ -1,10 +1,17 @@
+import asyncio
+import logging
 import os
-import json
-from datetime import datetime
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
 
 from dotenv import load_dotenv
-from sqlalchemy import Column, String, Float, DateTime, BigInteger, select
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy import (
+    JSON, Column, String, Float, Date, DateTime, BigInteger, Integer, Index, case, cast, delete, or_, select, text,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base
 
 load_dotenv()
@@ -15,11 +22,55 @@ DB_NAME = os.getenv("DB_NAME")
 DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 
-DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+# DATABASE_URL можно задать целиком, например sqlite+aiosqlite:///data/bench.db для нагрузочных тестов
+DATABASE_URL = os.getenv("DATABASE_URL") or f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+
+# Пул соединений: DB_POOL_SIZE постоянных и до DB_MAX_OVERFLOW временных сверху.
+# Обработчиков одновременно по умолчанию столько же, сколько постоянных соединений
+# (admission.ADMISSION_CONCURRENCY); запас остаётся фоновым задачам
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+
+# Каталог SQL-миграций, которые применяет migrate.sh
+MIGRATIONS_DIR = os.getenv("MIGRATIONS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrates"))
 
 Base = declarative_base()
-engine = create_async_engine(DATABASE_URL, echo=False)
-SessionLocal = async_sessionmaker(bind=engine, expire_on_commit=False)
+# Движок создаётся при первом обращении, а не при импорте модуля
+engine: AsyncEngine | None = None
+_session_factory: async_sessionmaker | None = None
+
+SETTINGS_CACHE_SIZE = int(os.getenv("SETTINGS_CACHE_SIZE", "10000"))
+# Через сколько секунд чистая запись кэша перечитывается из БД: правки с других реплик видны не позже
+SETTINGS_CACHE_TTL = float(os.getenv("SETTINGS_CACHE_TTL", "30"))
+SETTINGS_FLUSH_INTERVAL = float(os.getenv("SETTINGS_FLUSH_INTERVAL", "1.0"))  # секунды
+SETTINGS_FLUSH_BATCH = int(os.getenv("SETTINGS_FLUSH_BATCH", "500"))
+SETTINGS_CAS_RETRIES = int(os.getenv("SETTINGS_CAS_RETRIES", "3"))  # повторов сброса при конфликте версий
+
+logger = logging.getLogger(__name__)
+
+
+def get_engine() -> AsyncEngine:
+    global engine, _session_factory
+    if engine is None:
+        engine = create_async_engine(DATABASE_URL, echo=False, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+        _session_factory = async_sessionmaker(bind=engine, expire_on_commit=False)
+    return engine
+
+
+def new_session() -> AsyncSession:
+    get_engine()
+    return _session_factory()
+
+
+def insert(table):
+    # INSERT ... ON CONFLICT есть и в PostgreSQL, и в SQLite, но конструкции у диалектов свои
+    if get_engine().dialect.name == "sqlite":
+        return sqlite.insert(table)
+    return postgresql.insert(table)
+
+
+# Списки хранятся как JSONB; в SQLite (нагрузочный стенд) — как обычный JSON
+JsonList = JSONB().with_variant(JSON(), "sqlite")
 
 
 class UserSettings(Base):
@@ -28,29 +79,50 @@ class UserSettings(Base):
     user_id = Column(BigInteger, primary_key=True, index=True)
     base = Column(String, nullable=True)
     amount = Column(Float, default=1.0)
-    selected = Column(String, nullable=False, default="[]")
+    selected = Column(JsonList, nullable=False, default=list)
     msg_id = Column(BigInteger, nullable=True)  # одно сообщение
     message_sent_at = Column(DateTime, nullable=True)
     chat_id = Column(BigInteger, nullable=True)
-    recent_amounts = Column(String, nullable=False, default="[]")
+    recent_amounts = Column(JsonList, nullable=False, default=list)
     timezone = Column(String, nullable=True, default="UTC")  # <--- Новое поле
+    # changes — обновлять сообщение, когда изменились показанные курсы; publication — при каждой
+    # публикации ЦБ; off — только по /refresh
+    refresh_policy = Column(String(16), nullable=False, default="changes")
+    # Растёт при каждой записи; запись проходит, только если строку никто не менял с момента чтения
+    version = Column(BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        # «Кто следит за THB»: selected @> '["THB"]'
+        Index(
+            "idx_user_settings_selected", "selected",
+            postgresql_using="gin", postgresql_ops={"selected": "jsonb_path_ops"},
+        ),
+        # Кого обновлять после публикации ЦБ: обход по user_id только среди пользователей с сообщением
+        Index(
+            "idx_user_settings_refresh", "user_id",
+            postgresql_where=text("msg_id IS NOT NULL AND refresh_policy <> 'off'"),
+            sqlite_where=text("msg_id IS NOT NULL AND refresh_policy <> 'off'"),
+        ),
+    )
 
     def as_dict(self):
         return {
             "base": self.base,
             "amount": self.amount,
-            "selected": json.loads(self.selected),
+            "selected": list(self.selected or []),
             "msg_id": self.msg_id,
             "message_sent_at": self.message_sent_at.isoformat() if self.message_sent_at else None,
             "chat_id": self.chat_id,
-            "recent_amounts": json.loads(self.recent_amounts) if self.recent_amounts else [],
-            "timezone": self.timezone or "UTC"
+            "recent_amounts": list(self.recent_amounts or []),
+            "timezone": self.timezone or "UTC",
+            "refresh_policy": self.refresh_policy or "changes",
+            "version": self.version or 0,
         }
 
     def update_from_dict(self, data: dict):
         self.base = data.get("base")
         self.amount = data.get("amount", 1.0)
-        self.selected = json.dumps(data.get("selected", []))
+        self.selected = list(data.get("selected", []))
         self.msg_id = data.get("msg_id")
         self.chat_id = data.get("chat_id")
         sent_at = data.get("message_sent_at")
@@ -58,47 +130,539 @@ class UserSettings(Base):
             self.message_sent_at = sent_at if isinstance(sent_at, datetime) else datetime.fromisoformat(sent_at)
         recent = data.get("recent_amounts")
         if recent is not None:
-            self.recent_amounts = json.dumps(recent)
+            self.recent_amounts = list(recent)
         self.timezone = data.get("timezone", "UTC")
 
 
+class RateHistory(Base):
+    # Только добавление: один курс ЦБ на валюту и дату публикации
+    __tablename__ = "rates_history"
+
+    currency = Column(String(10), primary_key=True)
+    date = Column(Date, primary_key=True)
+    value = Column(Float, nullable=False)
+
+
+class RateRollup(Base):
+    # Агрегаты по дням (d), неделям (w) и месяцам (m), обновляются при каждом новом снимке
+    __tablename__ = "rates_rollups"
+
+    currency = Column(String(10), primary_key=True)
+    period = Column(String(1), primary_key=True)
+    period_start = Column(Date, primary_key=True)
+    open = Column(Float, nullable=False)
+    open_date = Column(Date, nullable=False)
+    close = Column(Float, nullable=False)
+    close_date = Column(Date, nullable=False)
+    high = Column(Float, nullable=False)
+    low = Column(Float, nullable=False)
+    total = Column(Float, nullable=False)
+    samples = Column(Integer, nullable=False)
+
+    def as_dict(self):
+        return {
+            "period_start": self.period_start,
+            "open": self.open,
+            "close": self.close,
+            "high": self.high,
+            "low": self.low,
+            "avg": self.total / self.samples if self.samples else None,
+            "samples": self.samples,
+        }
+
+
+class RateAlert(Base):
+    # Разовое уведомление: «сообщить, когда currency пересечёт threshold в quote»
+    __tablename__ = "rate_alerts"
+
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    user_id = Column(BigInteger, nullable=False, index=True)
+    chat_id = Column(BigInteger, nullable=False)
+    currency = Column(String(10), nullable=False)
+    quote = Column(String(10), nullable=False, default="RUB")
+    direction = Column(String(1), nullable=False)  # ">" или "<"
+    threshold = Column(Float, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.now)
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "chat_id": self.chat_id,
+            "currency": self.currency,
+            "quote": self.quote,
+            "direction": self.direction,
+            "threshold": self.threshold,
+        }
+
+
+ROLLUP_PERIODS = ("d", "w", "m")
+
+
+def period_start(day: date, period: str) -> date:
+    if period == "w":
+        return day - timedelta(days=day.weekday())
+    if period == "m":
+        return day.replace(day=1)
+    return day
+
+
+def expected_migrations() -> set[str]:
+    try:
+        names = os.listdir(MIGRATIONS_DIR)
+    except FileNotFoundError:
+        return set()
+    return {name for name in names if name.endswith(".sql") and not name.endswith("_down.sql")}
+
+
+async def applied_migrations() -> set[str] | None:
+    # None — таблицы migrations_applied нет (например, SQLite без migrate.sh)
+    try:
+        async with get_engine().connect() as conn:
+            result = await conn.execute(text("SELECT filename FROM migrations_applied"))
+            return {row[0] for row in result.all()}
+    except Exception:
+        return None
+
+
 async def init_db():
     os.makedirs("data", exist_ok=True)
-    async with engine.begin() as conn:
+    expected = expected_migrations()
+    applied = await applied_migrations()
+    if expected and applied is not None and expected <= applied:
+        # Схему ведёт migrate.sh и все миграции применены — create_all с отражением всех таблиц не нужен
+        logger.info("Схема БД актуальна: применено %d миграций", len(applied))
+        return
+    if applied is not None:
+        logger.warning("Не применены миграции: %s", ", ".join(sorted(expected - applied)))
+    async with get_engine().begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
 
 
+def default_settings() -> dict:
+    return {
+        "base": None,
+        "amount": 1.0,
+        "selected": [],
+        "msg_id": None,
+        "message_sent_at": None,
+        "chat_id": None,
+        "recent_amounts": [],
+        "timezone": None,
+        "refresh_policy": "changes",
+        "version": 0,
+    }
+
+
+def _copy_settings(data: dict) -> dict:
+    # Списки копируем, чтобы обработчики не меняли закэшированное значение
+    copy = dict(data)
+    for key in ("selected", "recent_amounts"):
+        if isinstance(copy.get(key), list):
+            copy[key] = list(copy[key])
+    return copy
+
+
+def _encode_field(key: str, value):
+    # Значение из словаря настроек -> значение колонки user_settings
+    if key in ("selected", "recent_amounts"):
+        return list(value) if value is not None else []
+    if key == "message_sent_at" and isinstance(value, str):
+        return datetime.fromisoformat(value)
+    if key == "amount" and value is None:
+        return 1.0
+    return value
+
+
+class SettingsCache:
+    # LRU-кэш настроек пользователей с отложенной записью: обработчики читают
+    # и пишут память, а изменённые поля пачками уходят в БД раз в SETTINGS_FLUSH_INTERVAL.
+    # Вместе с полями хранятся сами изменения (мутации): если строку в БД успел
+    # поменять другой процесс, они повторяются поверх свежей версии. Записи без
+    # несброшенных изменений живут ttl секунд с момента, когда совпадали с БД.
+
+    def __init__(self, max_size: int = SETTINGS_CACHE_SIZE, ttl: float = SETTINGS_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[int, dict] = OrderedDict()
+        # user_id -> когда запись последний раз совпадала с БД (прочитана или записана)
+        self._synced_at: dict[int, float] = {}
+        # user_id -> (последнее значение, поля и мутации с прошлого сброса)
+        self._dirty: dict[int, tuple[dict, set, list]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.conflicts = 0
+
+    def get(self, user_id: int) -> dict | None:
+        data = self._entries.get(user_id)
+        if data is not None:
+            if user_id not in self._dirty and time.monotonic() - self._synced_at[user_id] > self.ttl:
+                # Строку могла поменять другая реплика — перечитаем
+                del self._entries[user_id], self._synced_at[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return data
+        # Запись могла вытесниться из LRU, но ещё не попасть в БД
+        dirty = self._dirty.get(user_id)
+        return dirty[0] if dirty else None
+
+    def put(self, user_id: int, data: dict, fields: set | None = None, mutation=None):
+        self._entries[user_id] = data
+        self._entries.move_to_end(user_id)
+        if not fields or user_id not in self._synced_at:
+            # Без полей — значение только что из БД
+            self._synced_at[user_id] = time.monotonic()
+        if fields:
+            pending = self._dirty.get(user_id)
+            if pending:
+                self._dirty[user_id] = (data, pending[1] | fields, pending[2] + [mutation])
+            else:
+                self._dirty[user_id] = (data, set(fields), [mutation])
+        while len(self._entries) > self.max_size:
+            # Грязные записи не теряются: они остаются в _dirty до сброса
+            evicted, _ = self._entries.popitem(last=False)
+            self._synced_at.pop(evicted, None)
+
+    def take_dirty(self) -> dict[int, tuple[dict, set, list]]:
+        dirty, self._dirty = self._dirty, {}
+        return dirty
+
+    def restore_dirty(self, dirty: dict[int, tuple[dict, set, list]]):
+        for user_id, (data, fields, mutations) in dirty.items():
+            pending = self._dirty.get(user_id)
+            if pending:
+                # Во время сброса пришли более свежие изменения — берём их значения,
+                # но не забываем поля, которые так и не записались
+                self._dirty[user_id] = (pending[0], pending[1] | fields, mutations + pending[2])
+            else:
+                self._dirty[user_id] = (data, fields, mutations)
+
+    def committed(self, user_id: int, version: int):
+        # Запись прошла: следующий сброс будет сравнивать уже с новой версией
+        for data in (self._entries.get(user_id), self._dirty.get(user_id, (None,))[0]):
+            if data is not None:
+                data["version"] = version
+        if user_id in self._entries:
+            self._synced_at[user_id] = time.monotonic()
+
+    def rebase(self, user_id: int, fresh: dict, fields: set, mutations: list):
+        # CAS не прошёл: повторяем наши мутации поверх свежей строки из БД,
+        # включая те, что пришли уже во время сброса
+        self.conflicts += 1
+        pending = self._dirty.pop(user_id, None)
+        if pending:
+            fields, mutations = fields | pending[1], mutations + pending[2]
+        data = _copy_settings(fresh)
+        for mutation in mutations:
+            data.update(mutation(data))
+        self._entries[user_id] = data
+        self._synced_at[user_id] = time.monotonic()
+        self._dirty[user_id] = (data, fields, mutations)
+
+    def has_dirty(self) -> bool:
+        return bool(self._dirty)
+
+
+settings_cache = SettingsCache()
+
+
 async def load_user_settings(user_id: int) -> dict:
-    async with SessionLocal() as session:
-        result = await session.execute(select(UserSettings).where(UserSettings.user_id == user_id))
-        row = result.scalar_one_or_none()
-        if row:
-            return row.as_dict()
-        else:
-            return {
-                "base": None,
-                "amount": 1.0,
-                "selected": [],
-                "msg_id": None,
-                "message_sent_at": None,
-                "chat_id": None,
-                "recent_amounts": [],
-                "timezone": None
-            }
-
-
-async def save_user_settings(user_id: int, data: dict):
-    async with SessionLocal() as session:
+    cached = settings_cache.get(user_id)
+    if cached is not None:
+        settings_cache.hits += 1
+        return _copy_settings(cached)
+
+    settings_cache.misses += 1
+    async with new_session() as session:
         result = await session.execute(select(UserSettings).where(UserSettings.user_id == user_id))
         row = result.scalar_one_or_none()
-        if not row:
-            row = UserSettings(user_id=user_id)
-            session.add(row)
-        row.update_from_dict(data)
+        data = row.as_dict() if row else default_settings()
+
+    # Пока шёл запрос, настройки могли успеть сохранить — они новее, чем прочитанное из БД
+    cached = settings_cache.get(user_id)
+    if cached is not None:
+        return _copy_settings(cached)
+    settings_cache.put(user_id, data)
+    return _copy_settings(data)
+
+
+def peek_user_settings(user_id: int) -> dict | None:
+    # Только кэш, без запроса к БД. Возвращает сам закэшированный словарь — не изменять
+    return settings_cache.get(user_id)
+
+
+async def iter_refresh_candidates(batch_size: int = 1000, shard: tuple[int, int] | None = None,
+                                  currencies=None):
+    # Пользователи с динамическим сообщением и включённым автообновлением, пачками
+    # по keyset-пагинации user_id. Отдаёт (user_id, настройки); настройки из кэша
+    # свежее строки БД. shard=(index, count) оставляет только пользователей своего воркера.
+    # currencies — изменившиеся валюты: с политикой changes остаются лишь те, кто следит
+    # хотя бы за одной из них (по GIN-индексу selected)
+    last_id = None
+    while True:
+        query = select(UserSettings).where(UserSettings.msg_id.is_not(None), UserSettings.refresh_policy != "off")
+        if currencies is not None:
+            query = query.where(or_(
+                UserSettings.refresh_policy == "publication", *(_tracks(code) for code in sorted(currencies))
+            ))
+        if shard is not None:
+            query = query.where(UserSettings.user_id % shard[1] == shard[0])
+        if last_id is not None:
+            query = query.where(UserSettings.user_id > last_id)
+        query = query.order_by(UserSettings.user_id).limit(batch_size)
+
+        async with new_session() as session:
+            result = await session.execute(query)
+            rows = result.scalars().all()
+        if not rows:
+            return
+
+        batch = []
+        for row in rows:
+            # Заодно прогреваем кэш, чтобы show_rates не ходил в БД за каждым
+            settings = settings_cache.get(row.user_id)
+            if settings is None:
+                settings = row.as_dict()
+                settings_cache.put(row.user_id, settings)
+            batch.append((row.user_id, settings))
+        yield batch
+
+        last_id = rows[-1].user_id
+        if len(rows) < batch_size:
+            return
+
+
+def _tracks(currency: str):
+    if get_engine().dialect.name == "sqlite":
+        # В SQLite нет @> и GIN — ищем по тексту JSON, годится только для стендов
+        return cast(UserSettings.selected, String).like(f'%"{currency}"%')
+    return UserSettings.selected.contains([currency])
+
+
+async def mutate_user_settings(user_id: int, mutation) -> dict:
+    # mutation(settings) -> словарь новых значений полей. Применяется к кэшу без
+    # await между чтением и записью, поэтому параллельные обработчики не затирают
+    # друг друга; при конфликте версий в БД её повторит flush_user_settings.
+    current = settings_cache.get(user_id)
+    if current is None:
+        current = await load_user_settings(user_id)
+        # За время загрузки запись могла обновиться
+        current = settings_cache.get(user_id) or current
+    fields = mutation(current)
+    fields.pop("version", None)
+    # В БД уйдут лишь поля, которые действительно изменились
+    changed = {key for key, value in fields.items() if key not in current or current[key] != value}
+    data = _copy_settings(current)
+    data.update(fields)
+    settings_cache.put(user_id, data, changed, mutation)
+    return _copy_settings(data)
+
+
+async def update_user_settings(user_id: int, **fields) -> dict:
+    return await mutate_user_settings(user_id, lambda _settings: dict(fields))
+
+
+async def set_base(user_id: int, base: str | None):
+    await update_user_settings(user_id, base=base)
+
+
+async def change_amount(user_id: int, change) -> dict:
+    # Относительные изменения (+10, ×2) считаются от актуального значения, а не от прочитанного раньше
+    return await mutate_user_settings(user_id, lambda settings: {"amount": change(settings["amount"])})
+
+
+async def toggle_selected(user_id: int, currency: str) -> dict:
+    def toggle(settings: dict) -> dict:
+        selected = list(settings.get("selected") or [])
+        if currency in selected:
+            selected.remove(currency)
+            return {"selected": selected}
+        selected.append(currency)
+        if len(selected) == 1:
+            return {"selected": selected, "base": currency}
+        return {"selected": selected}
+
+    return await mutate_user_settings(user_id, toggle)
+
+
+async def set_timezone(user_id: int, timezone: str):
+    await update_user_settings(user_id, timezone=timezone)
+
+
+async def set_refresh_policy(user_id: int, policy: str):
+    await update_user_settings(user_id, refresh_policy=policy)
+
+
+async def set_dynamic_message(user_id: int, msg_id: int | None, sent_at: datetime | None):
+    await update_user_settings(user_id, msg_id=msg_id, message_sent_at=sent_at)
+
+
+def _upsert_statement(fields: frozenset, rows: list[dict]):
+    # rows[i]["version"] — ожидаемая версия + 1. Строка обновляется, только если её версия
+    # не менялась с чтения; RETURNING отдаёт тех, кого удалось записать.
+    stmt = insert(UserSettings).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[UserSettings.user_id],
+        set_={**{key: stmt.excluded[key] for key in fields}, "version": stmt.excluded.version},
+        where=UserSettings.__table__.c.version == stmt.excluded.version - 1,
+    ).returning(UserSettings.user_id, UserSettings.version)
+
+
+async def _rebase_conflicts(conflicts: dict[int, tuple[dict, set, list]]):
+    async with new_session() as session:
+        result = await session.execute(select(UserSettings).where(UserSettings.user_id.in_(list(conflicts))))
+        fresh = {row.user_id: row.as_dict() for row in result.scalars().all()}
+    for user_id, (_, fields, mutations) in conflicts.items():
+        settings_cache.rebase(user_id, fresh.get(user_id) or default_settings(), fields, mutations)
+
+
+async def _flush_once() -> int:
+    # Возвращает число конфликтов версий: их изменения уже перенесены на свежие строки
+    dirty = settings_cache.take_dirty()
+    if not dirty:
+        return 0
+
+    # Один INSERT ... ON CONFLICT на каждый набор изменённых полей
+    groups: dict[frozenset, list[int]] = {}
+    for user_id, (_, fields, _) in dirty.items():
+        groups.setdefault(frozenset(fields), []).append(user_id)
+
+    conflicts = {}
+    try:
+        for fields, user_ids in groups.items():
+            for start in range(0, len(user_ids), SETTINGS_FLUSH_BATCH):
+                batch = user_ids[start:start + SETTINGS_FLUSH_BATCH]
+                rows = [
+                    {
+                        "user_id": user_id,
+                        "version": dirty[user_id][0]["version"] + 1,
+                        **{key: _encode_field(key, dirty[user_id][0].get(key)) for key in fields},
+                    }
+                    for user_id in batch
+                ]
+                async with new_session() as session:
+                    result = await session.execute(_upsert_statement(fields, rows))
+                    written = dict(result.all())
+                    await session.commit()
+                for user_id in batch:
+                    if user_id in written:
+                        settings_cache.committed(user_id, written[user_id])
+                    else:
+                        conflicts[user_id] = dirty[user_id]
+                    dirty.pop(user_id)
+        if conflicts:
+            await _rebase_conflicts(conflicts)
+    except Exception:
+        logger.exception("Не удалось сохранить настройки %d пользователей", len(dirty) + len(conflicts))
+        settings_cache.restore_dirty({**dirty, **conflicts})
+        return 0
+    return len(conflicts)
+
+
+async def flush_user_settings():
+    for _ in range(SETTINGS_CAS_RETRIES + 1):
+        conflicts = await _flush_once()
+        if not conflicts:
+            return
+        logger.info("Настройки %d пользователей изменились в БД параллельно, повторяем запись", conflicts)
+    # Оставшиеся конфликты уже в очереди на запись и уйдут со следующим сбросом
+
+
+async def run_settings_flusher(interval: float = SETTINGS_FLUSH_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        await flush_user_settings()
+
+
+async def close_db():
+    await flush_user_settings()
+    if engine is not None:
+        await engine.dispose()
+
+
+def _rollup_upsert(rows: list[dict]):
+    stmt = insert(RateRollup).values(rows)
+    current, new = RateRollup.__table__.c, stmt.excluded
+    return stmt.on_conflict_do_update(
+        index_elements=[RateRollup.currency, RateRollup.period, RateRollup.period_start],
+        set_={
+            "open": case((new.open_date < current.open_date, new.open), else_=current.open),
+            "open_date": case((new.open_date < current.open_date, new.open_date), else_=current.open_date),
+            "close": case((new.close_date > current.close_date, new.close), else_=current.close),
+            "close_date": case((new.close_date > current.close_date, new.close_date), else_=current.close_date),
+            "high": case((new.high > current.high, new.high), else_=current.high),
+            "low": case((new.low < current.low, new.low), else_=current.low),
+            "total": current.total + new.total,
+            "samples": current.samples + new.samples,
+        },
+    )
+
+
+async def record_rate_snapshot(day: date, rates: dict) -> int:
+    # Сохраняет снимок ЦБ за дату публикации и досчитывает агрегаты только по новым строкам.
+    # Возвращает число новых строк (0 — такой снимок уже был).
+    rows = [{"currency": code, "date": day, "value": value} for code, value in rates.items() if code != "RUB"]
+    if not rows:
+        return 0
+
+    async with new_session() as session:
+        stmt = insert(RateHistory).values(rows).on_conflict_do_nothing().returning(RateHistory.currency)
+        inserted = {row[0] for row in (await session.execute(stmt)).all()}
+        if inserted:
+            rollups = [
+                {
+                    "currency": code, "period": period, "period_start": period_start(day, period),
+                    "open": rates[code], "open_date": day, "close": rates[code], "close_date": day,
+                    "high": rates[code], "low": rates[code], "total": rates[code], "samples": 1,
+                }
+                for code in inserted
+                for period in ROLLUP_PERIODS
+            ]
+            await session.execute(_rollup_upsert(rollups))
+        await session.commit()
+    return len(inserted)
+
+
+async def get_rate_rollups(currency: str, period: str, limit: int) -> list[dict]:
+    # Последние limit периодов, от новых к старым; читается по первичному ключу
+    async with new_session() as session:
+        result = await session.execute(
+            select(RateRollup)
+            .where(RateRollup.currency == currency, RateRollup.period == period)
+            .order_by(RateRollup.period_start.desc())
+            .limit(limit)
+        )
+        return [row.as_dict() for row in result.scalars().all()]
+
+
+async def add_rate_alert(user_id: int, chat_id: int, currency: str, quote: str, direction: str,
+                         threshold: float) -> dict:
+    alert = RateAlert(
+        user_id=user_id, chat_id=chat_id, currency=currency, quote=quote, direction=direction, threshold=threshold
+    )
+    async with new_session() as session:
+        session.add(alert)
         await session.commit()
+        return alert.as_dict()
 
 
-async def get_all_users():
-    async with SessionLocal() as session:
-        result = await session.execute(select(UserSettings.user_id).distinct())
-        return [{"user_id": row[0]} for row in result.all()]
+async def load_rate_alerts(shard: tuple[int, int] | None = None) -> list[dict]:
+    query = select(RateAlert)
+    if shard is not None:
+        query = query.where(RateAlert.user_id % shard[1] == shard[0])
+    async with new_session() as session:
+        result = await session.execute(query)
+        return [row.as_dict() for row in result.scalars().all()]
+
+
+async def delete_rate_alerts(alert_ids: list[int], user_id: int | None = None) -> set[int]:
+    # -> id, которые удалил именно этот вызов. user_id — удалять только уведомления
+    # этого пользователя (команда /unalert)
+    query = delete(RateAlert).where(RateAlert.id.in_(alert_ids))
+    if user_id is not None:
+        query = query.where(RateAlert.user_id == user_id)
+    async with new_session() as session:
+        result = await session.execute(query.returning(RateAlert.id))
+        deleted = set(result.scalars().all())
+        await session.commit()
+        return deleted
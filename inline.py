@@ -0,0 +1,104 @@
+import os
+import re
+
+from aiogram import types
+
+from keyboards import LRUCache, format_value, get_flag_by_currency
+from rates import RateSnapshot
+
+INLINE_CACHE_SIZE = int(os.getenv("INLINE_CACHE_SIZE", "4096"))
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "60"))  # секунды, не дольше жизни снимка курсов
+INLINE_DEFAULT_TARGETS = ("RUB", "USD", "EUR", "CNY")  # пока настроек пользователя нет в кэше
+INLINE_MAX_TARGETS = 20
+
+CURRENCY_ALIASES = {"$": "USD", "€": "EUR", "£": "GBP", "₽": "RUB", "Р": "RUB", "РУБ": "RUB"}
+
+# «250 usd», «usd 250», «1000,5 €», «250»
+AMOUNT_PATTERN = re.compile(r"\d+(?:[.,]\d+)?")
+CODE_PATTERN = re.compile(r"[A-Za-z]{3}|[$€£₽]|руб|р", re.IGNORECASE)
+
+# (версия снимка, сумма, исходная валюта, целевые валюты) -> готовые результаты
+inline_results_cache = LRUCache(INLINE_CACHE_SIZE)
+
+
+def parse_inline_query(query: str) -> tuple[float, str | None] | None:
+    # -> (сумма, код валюты или None); None — запрос не похож на сумму
+    query = query.strip()
+    if not query:
+        return 1.0, None
+    amount_match = AMOUNT_PATTERN.search(query)
+    rest = query if amount_match is None else query[:amount_match.start()] + " " + query[amount_match.end():]
+    code_match = CODE_PATTERN.search(rest)
+    leftover = rest if code_match is None else rest[:code_match.start()] + rest[code_match.end():]
+    if leftover.strip():
+        return None
+    amount = float(amount_match.group().replace(",", ".")) if amount_match else 1.0
+    code = None
+    if code_match:
+        code = code_match.group().upper()
+        code = CURRENCY_ALIASES.get(code, code)
+    return amount, code
+
+
+def inline_targets(settings: dict | None, source: str, snapshot: RateSnapshot) -> tuple[str, ...]:
+    selected = (settings or {}).get("selected") or INLINE_DEFAULT_TARGETS
+    targets = tuple(code for code in selected if code != source and code in snapshot.index)
+    if source != "RUB" and "RUB" not in targets:
+        # Рубль — валюта котировок ЦБ, показываем его всегда
+        targets += ("RUB",)
+    return targets[:INLINE_MAX_TARGETS]
+
+
+def _label(code: str) -> str:
+    flag = get_flag_by_currency(code)
+    return f"{flag} {code}" if flag else code
+
+
+def render_inline_results(snapshot: RateSnapshot, amount: float, source: str,
+                          targets: tuple[str, ...]) -> list[types.InlineQueryResultArticle]:
+    values = snapshot.convert_many(amount, source, targets)
+    prefix = f"{snapshot.version}:{amount:g}:{source}"
+    header = f"{format_value(amount)} {_label(source)}"
+    lines = [f"{format_value(value)} {_label(code)}" for code, value in zip(targets, values)]
+    results = [
+        types.InlineQueryResultArticle(
+            id=f"{prefix}:all",
+            title=f"{header} во все валюты",
+            description=", ".join(f"{format_value(value)} {code}" for code, value in zip(targets, values)),
+            input_message_content=types.InputTextMessageContent(message_text="\n".join([f"{header} =", *lines])),
+        )
+    ]
+    for code, value, line in zip(targets, values, lines):
+        results.append(types.InlineQueryResultArticle(
+            id=f"{prefix}:{code}",
+            title=f"{format_value(value)} {code}",
+            description=f"{header} по курсу ЦБ",
+            input_message_content=types.InputTextMessageContent(message_text=f"{header} = {line}"),
+        ))
+    return results
+
+
+def build_inline_results(query: str, settings: dict | None,
+                         snapshot: RateSnapshot) -> list[types.InlineQueryResultArticle]:
+    # Только память: снимок курсов и закэшированные настройки, без БД и HTTP
+    parsed = parse_inline_query(query)
+    if parsed is None:
+        return []
+    amount, source = parsed
+    if source is None:
+        source = (settings or {}).get("base") or "USD"
+    if source not in snapshot.index:
+        return []
+    targets = inline_targets(settings, source, snapshot)
+
+    key = (snapshot.version, amount, source, targets)
+    results = inline_results_cache.get(key)
+    if results is None:
+        results = render_inline_results(snapshot, amount, source, targets)
+        inline_results_cache.put(key, results)
+    return results
+
+
+def inline_cache_time(snapshot: RateSnapshot, ttl: float) -> int:
+    # Telegram не должен отдавать ответ дольше, чем живёт снимок курсов
+    return max(0, min(INLINE_CACHE_TIME, int(ttl - snapshot.age())))
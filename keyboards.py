@@ -0,0 +1,191 @@
+import os
+from collections import OrderedDict
+
+from aiogram import types
+
+from rates import RateSnapshot
+
+KEYBOARD_CACHE_SIZE = int(os.getenv("KEYBOARD_CACHE_SIZE", "4096"))
+
+CURRENCY_TO_COUNTRY = {
+    "USD": "US",
+    "EUR": "EU",
+    "RUB": "RU",
+    "CNY": "CN",
+    "GBP": "GB",
+    "JPY": "JP",
+    "TRY": "TR",
+    "KZT": "KZ",
+    "IDR": "ID",
+    "VND": "VN",
+    "THB": "TH",
+    "AED": "AE",
+    "KGS": "KG",
+    "SGD": "SG"
+}
+
+
+class LRUCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        value = self._data.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Готовые клавиатуры: разметка зависит только от ключа, а не от пользователя
+currency_keyboard_cache = LRUCache(KEYBOARD_CACHE_SIZE)
+rates_keyboard_cache = LRUCache(KEYBOARD_CACHE_SIZE)
+
+
+def clear_keyboard_caches(_snapshot: RateSnapshot | None = None):
+    currency_keyboard_cache.clear()
+    rates_keyboard_cache.clear()
+
+
+def country_flag(country_code: str) -> str:
+    return ''.join(chr(127397 + ord(c)) for c in country_code.upper())
+
+
+def get_flag_by_currency(code: str) -> str:
+    country = CURRENCY_TO_COUNTRY.get(code)
+    return country_flag(country) if country else ""
+
+
+def format_value(value: float) -> str:
+    return f"{value:,.2f}".replace(",", " ")  # Форматируем число красиво с пробелами: 1 000 000.00
+
+
+def format_currency_text(code: str, value_part: str, target_column: int, is_base=False) -> str:
+    flag = get_flag_by_currency(code)
+    if flag:
+        code_with_flag = f"{flag} {code}"
+    else:
+        code_with_flag = code
+
+    spaces_needed = target_column - len(code_with_flag)
+    spaces_needed = max(spaces_needed, 1)  # хотя бы один пробел
+
+    if is_base:
+        left_spaces = spaces_needed // 2
+        right_spaces = spaces_needed - left_spaces
+        spaces = " " * left_spaces + "⭐" + " " * right_spaces
+    else:
+        spaces = " " * spaces_needed
+
+    return f"{code_with_flag}{spaces}{value_part}"
+
+
+def build_reply_keyboard():
+    return types.ReplyKeyboardMarkup(
+        keyboard=[
+            [
+                types.KeyboardButton(text="+1"),
+                types.KeyboardButton(text="+10"),
+                types.KeyboardButton(text="+100"),
+                types.KeyboardButton(text="+1000"),
+                types.KeyboardButton(text="+1000000"),
+            ],
+            [
+                types.KeyboardButton(text="×2"),
+                types.KeyboardButton(text="×10"),
+                types.KeyboardButton(text="÷2"),
+                types.KeyboardButton(text="÷10"),
+                types.KeyboardButton(text="🔄")
+            ]
+        ],
+        resize_keyboard=True,
+        one_time_keyboard=False
+    )
+
+
+def _markup(buttons: list, width: int) -> types.InlineKeyboardMarkup:
+    # Разметку собираем напрямую: InlineKeyboardBuilder.button() валидирует и копирует
+    # каждую кнопку и на 40 валютах в десятки раз медленнее
+    rows = [buttons[i:i + width] for i in range(0, len(buttons), width)]
+    return types.InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def rates_values(selected_currencies, base_currency, snapshot: RateSnapshot, amount) -> dict[str, str]:
+    # Значения ровно в том виде, в каком они попадут на кнопки
+    converted = snapshot.convert_many(amount, base_currency, selected_currencies).tolist()
+    return {
+        currency: format_value(amount if currency == base_currency else value)
+        for currency, value in zip(selected_currencies, converted)
+    }
+
+
+def render_rates_keyboard(selected_currencies, base_currency, snapshot: RateSnapshot, amount):
+
+    # Сначала форматируем все значения, чтобы понять максимальную длину
+    values = rates_values(selected_currencies, base_currency, snapshot, amount)
+
+    # Найти максимальную длину числа для правильного выравнивания
+    max_value_length = max(len(v) for v in values.values())
+    target_column = 40 - max_value_length  # оставляем место для самого длинного числа
+
+    # Теперь создаём кнопки
+    buttons = []
+    for currency in selected_currencies:
+        text = format_currency_text(
+            code=currency,
+            value_part=values[currency],
+            target_column=target_column,
+            is_base=(currency == base_currency)
+        )
+        buttons.append(types.InlineKeyboardButton(text=text, callback_data=f"base_{currency}"))
+
+    buttons.append(types.InlineKeyboardButton(text="🔙 Изменить выбор валют", callback_data="back_to_selection"))
+    return _markup(buttons, 1)
+
+
+def render_currency_keyboard(all_currencies, selected_currencies):
+    buttons = []
+    for currency in all_currencies:
+        if currency in selected_currencies:
+            text = f"✅ {currency}"
+        else:
+            text = f"❌ {currency}"
+        buttons.append(types.InlineKeyboardButton(text=text, callback_data=f"select_{currency}"))
+
+    buttons.append(types.InlineKeyboardButton(text="➡️ Показать курсы", callback_data="show_rates"))
+    return _markup(buttons, 4)
+
+
+def build_rates_keyboard(selected_currencies, base_currency, snapshot: RateSnapshot, amount):
+    key = (snapshot.version, tuple(selected_currencies), base_currency, amount)
+    markup = rates_keyboard_cache.get(key)
+    if markup is None:
+        markup = render_rates_keyboard(selected_currencies, base_currency, snapshot, amount)
+        rates_keyboard_cache.put(key, markup)
+    return markup
+
+
+def build_currency_keyboard(all_currencies, selected_currencies):
+    key = (tuple(all_currencies), frozenset(selected_currencies))
+    markup = currency_keyboard_cache.get(key)
+    if markup is None:
+        markup = render_currency_keyboard(all_currencies, set(selected_currencies))
+        currency_keyboard_cache.put(key, markup)
+    return markup
@@ -1,46 +1,113 @@
 import asyncio
+import contextvars
+import hashlib
 import logging
 import os
+import time
+from collections import OrderedDict
 from datetime import datetime
 
-import requests
 import pytz
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import CommandStart, Command
+from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from dotenv import load_dotenv
 
-from db import init_db, load_user_settings, save_user_settings, get_all_users
+from db import (
+    init_db, load_user_settings, peek_user_settings, update_user_settings, iter_refresh_candidates, run_settings_flusher,
+    close_db, set_refresh_policy,
+    change_amount, set_base, toggle_selected, set_timezone, set_dynamic_message,
+    record_rate_snapshot, get_rate_rollups, add_rate_alert, load_rate_alerts, delete_rate_alerts,
+)
+import db
+from admission import AdmissionControl, AdmissionMiddleware, AdmissionSlotMiddleware
+from background import CallbackAckMiddleware, KeyedTaskQueue
+from alerts import ALERTS_PER_USER, Alert, alert_index, alert_notifier, format_alert, is_triggered, parse_alert
+from inline import build_inline_results, inline_cache_time, inline_results_cache
+from keyboards import (
+    build_reply_keyboard, build_rates_keyboard, rates_values, build_currency_keyboard, clear_keyboard_caches,
+    currency_keyboard_cache, rates_keyboard_cache,
+)
+from metrics import (
+    METRICS_PORT, STARTUP_STEP_SECONDS, HandlerMetricsMiddleware, TelegramMetricsMiddleware, UpdateTraceMiddleware,
+    instrument_engine, mark_ready, observe_visible, register_admission, register_background, register_cache, register_sender,
+    start_metrics_server,
+)
+from rates import rates_cache
+from sender import sender, INTERACTIVE, BACKGROUND
+from webhook import run_webhook
+from sharding import run_sharded
 
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-
-logging.basicConfig(level=logging.INFO)
-bot = Bot(
-    token=BOT_TOKEN,
-    default=DefaultBotProperties(parse_mode="HTML")
-)
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # свой Bot API сервер или заглушка для тестов
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "0"))  # 0 — всё в одном процессе
+
+RATES_POLL_INTERVAL = float(os.getenv("RATES_POLL_INTERVAL", "600"))  # как часто проверять новую публикацию ЦБ
+REFRESH_WORKERS = int(os.getenv("REFRESH_WORKERS", "16"))
+REFRESH_BATCH = int(os.getenv("REFRESH_BATCH", "1000"))
+HISTORY_DAYS = 7
+HISTORY_WEEKS = 8
+HISTORY_MONTHS = 12
+RENDER_DEBOUNCE = float(os.getenv("RENDER_DEBOUNCE", "0.3"))  # окно склейки быстрых нажатий, секунды
+RENDERED_CACHE_SIZE = 10000
+
+# Bot создаётся при запуске (get_bot), чтобы импорт модуля не требовал токена и сети
+bot: Bot | None = None
 dp = Dispatcher()
+# Нажатия кнопок: ответ Telegram сразу, обработка — в очереди пользователя
+callback_tasks = KeyedTaskQueue()
+# Ограничение одновременных обработчиков и очереди каждого пользователя (inline-запросы идут мимо)
+admission = AdmissionControl()
+dp.update.outer_middleware(UpdateTraceMiddleware())
+dp.update.outer_middleware(AdmissionMiddleware(admission, lambda update: _supersede_kind(update)))
+dp.message.middleware(AdmissionSlotMiddleware(admission, lambda event: _on_superseded(event)))
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(CallbackAckMiddleware(callback_tasks))
+dp.callback_query.middleware(AdmissionSlotMiddleware(admission))
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+dp.inline_query.middleware(HandlerMetricsMiddleware())
+rates_cache.add_listener(clear_keyboard_caches)
+rates_cache.add_listener(lambda snapshot: inline_results_cache.clear())
+rates_cache.add_listener(lambda snapshot: _record_history(snapshot))
+rates_cache.add_listener(lambda snapshot: _check_alerts(snapshot))
+rates_cache.add_listener(lambda snapshot: _on_new_snapshot(snapshot))
+
+# (chat_id, msg_id) -> хэш последнего отправленного текста и разметки
+_last_rendered: OrderedDict[tuple, str] = OrderedDict()
+# Отрисовки курсов по пользователям: задача и контекст нажатия, ждущего повторной отрисовки
+_pending_renders: dict[int, asyncio.Task] = {}
+_rerender: dict[int, contextvars.Context] = {}
+_background_tasks: set[asyncio.Task] = set()
+# Шард этого процесса: (index, count) в режиме WORKER_PROCESSES, иначе None
+_shard: tuple[int, int] | None = None
+# Пользователи, чьи настройки сейчас подгружаются в кэш ради inline-режима
+_settings_warmups: set[int] = set()
+# Дата последнего снимка ЦБ, уже записанного в историю
+_last_history_date = None
+
+
+def get_bot() -> Bot:
+    global bot
+    if bot is None:
+        bot = Bot(
+            token=BOT_TOKEN,
+            session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+            default=DefaultBotProperties(parse_mode="HTML")
+        )
+        bot.session.middleware(TelegramMetricsMiddleware())
+    return bot
+
 
-CURRENCY_URL = "https://www.cbr-xml-daily.ru/daily_json.js"
-
-CURRENCY_TO_COUNTRY = {
-    "USD": "US",
-    "EUR": "EU",
-    "RUB": "RU",
-    "CNY": "CN",
-    "GBP": "GB",
-    "JPY": "JP",
-    "TRY": "TR",
-    "KZT": "KZ",
-    "IDR": "ID",
-    "VND": "VN",
-    "THB": "TH",
-    "AED": "AE",
-    "KGS": "KG",
-    "SGD": "SG"
+REFRESH_POLICIES = {
+    "changes": "Когда меняются мои курсы",
+    "publication": "При каждой публикации ЦБ",
+    "off": "Только по /refresh",
 }
 
 popular_timezones = [
@@ -51,127 +118,18 @@ popular_timezones = [
 ]
 
 
-def country_flag(country_code: str) -> str:
-    return ''.join(chr(127397 + ord(c)) for c in country_code.upper())
-
-
-def get_flag_by_currency(code: str) -> str:
-    country = CURRENCY_TO_COUNTRY.get(code)
-    return country_flag(country) if country else ""
-
-
 async def fetch_currencies():
-    response = requests.get(CURRENCY_URL)
-    data = response.json()
-    currencies = list(data["Valute"].keys())
-    currencies.append("RUB")
-    rates = {"RUB": 1.0}
-    for code, details in data["Valute"].items():
-        rates[code] = details["Value"] / details["Nominal"]
-    return currencies, rates
-
-
-async def format_currency_text(code: str, value: float, target_column: int, is_base=False) -> str:
-    flag = get_flag_by_currency(code)
-    if flag:
-        code_with_flag = f"{flag} {code}"
-    else:
-        code_with_flag = code
-
-    value_part = f"{value:,.2f}".replace(",", " ")  # Форматируем число красиво с пробелами: 1 000 000.00
-
-    spaces_needed = target_column - len(code_with_flag)
-    spaces_needed = max(spaces_needed, 1)  # хотя бы один пробел
-
-    if is_base:
-        left_spaces = spaces_needed // 2
-        right_spaces = spaces_needed - left_spaces
-        spaces = " " * left_spaces + "⭐" + " " * right_spaces
-    else:
-        spaces = " " * spaces_needed
-
-    return f"{code_with_flag}{spaces}{value_part}"
-
-
-def build_reply_keyboard():
-    return types.ReplyKeyboardMarkup(
-        keyboard=[
-            [
-                types.KeyboardButton(text="+1"),
-                types.KeyboardButton(text="+10"),
-                types.KeyboardButton(text="+100"),
-                types.KeyboardButton(text="+1000"),
-                types.KeyboardButton(text="+1000000"),
-            ],
-            [
-                types.KeyboardButton(text="×2"),
-                types.KeyboardButton(text="×10"),
-                types.KeyboardButton(text="÷2"),
-                types.KeyboardButton(text="÷10"),
-                types.KeyboardButton(text="🔄")
-            ]
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=False
-    )
-
-
-async def build_rates_keyboard(selected_currencies, base_currency, rates, amount):
-    builder = InlineKeyboardBuilder()
-
-    # Сначала собираем все value_part, чтобы понять максимальную длину
-    values = {}
-    for currency in selected_currencies:
-        if currency == base_currency:
-            values[currency] = amount
-        else:
-            values[currency] = (rates[base_currency] / rates[currency]) * amount
-
-    # Найти максимальную длину числа для правильного выравнивания
-    max_value_length = max(len(f"{v:,.2f}".replace(",", " ")) for v in values.values())
-    target_column = 40 - max_value_length  # оставляем место для самого длинного числа
-
-    # Теперь создаём кнопки
-    for currency in selected_currencies:
-        value = values[currency]
-        text = await format_currency_text(
-            code=currency,
-            value=value,
-            target_column=target_column,
-            is_base=(currency == base_currency)
-        )
-        builder.button(text=text, callback_data=f"base_{currency}")
-
-    builder.button(text="🔙 Изменить выбор валют", callback_data="back_to_selection")
-    builder.adjust(1)
-    return builder.as_markup()
-
-
-async def build_currency_keyboard(all_currencies, selected_currencies):
-    builder = InlineKeyboardBuilder()
-    for idx, currency in enumerate(all_currencies):
-        if currency in selected_currencies:
-            text = f"✅ {currency}"
-        else:
-            text = f"❌ {currency}"
-        builder.button(text=text, callback_data=f"select_{currency}")
-        if (idx + 1) % 4 == 0:
-            builder.adjust(4)
-
-    builder.button(text="➡️ Показать курсы", callback_data="show_rates")
-    builder.adjust(4)
-    return builder.as_markup()
+    snapshot = await rates_cache.get()
+    return snapshot.currencies, snapshot.rates
 
 
-async def delete_user_message(message: types.Message):
-    try:
-        await message.delete()
-    except Exception:
-        pass
+def delete_user_message(message: types.Message):
+    # Фоновый приоритет и без ожидания: не задерживает правку, которую ждёт пользователь
+    sender.delete_message_nowait(chat_id=message.chat.id, message_id=message.message_id)
 
 
 async def send_welcome_message(chat_id: int):
-    await bot.send_message(
+    await sender.send_message(
         chat_id=chat_id,
         text="Добро пожаловать!",
         reply_markup=build_reply_keyboard()
@@ -184,43 +142,70 @@ async def recreate_dynamic_message(user_id: int, text: str, reply_markup):
     # Удаляем старое динамическое сообщение, если есть
     if settings.get("msg_id"):
         try:
-            await bot.delete_message(chat_id=settings["chat_id"], message_id=settings["msg_id"])
-        except Exception:
-            pass
+            await sender.delete_message(chat_id=settings["chat_id"], message_id=settings["msg_id"])
+        except Exception as e:
+            logging.debug("Не удалось удалить старое сообщение: %r", e)
 
-    sent = await bot.send_message(
+    sent = await sender.send_message(
         chat_id=settings["chat_id"],
         text=text,
         reply_markup=reply_markup
     )
-    settings["msg_id"] = sent.message_id
-    settings["message_sent_at"] = datetime.now()
-    await save_user_settings(user_id, settings)
+    _last_rendered.pop((settings["chat_id"], settings["msg_id"]), None)
+    _remember_render((settings["chat_id"], sent.message_id), _render_hash(text, reply_markup))
+    observe_visible()
+    await set_dynamic_message(user_id, sent.message_id, datetime.now())
+
+
+def _render_hash(text: str, reply_markup) -> str:
+    markup = reply_markup.model_dump_json(exclude_none=True) if reply_markup is not None else ""
+    return hashlib.blake2b(f"{text}\0{markup}".encode(), digest_size=16).hexdigest()
 
 
-async def update_dynamic_message(user_id: int, text: str, reply_markup):
+def _remember_render(key: tuple, digest: str):
+    _last_rendered[key] = digest
+    _last_rendered.move_to_end(key)
+    if len(_last_rendered) > RENDERED_CACHE_SIZE:
+        _last_rendered.popitem(last=False)
+
+
+async def update_dynamic_message(user_id: int, text: str, reply_markup, priority: int = INTERACTIVE):
     settings = await load_user_settings(user_id)
+    if not settings.get("msg_id"):
+        return
+
+    # Такой же текст и клавиатура уже в сообщении — Telegram ответит "message is not modified"
+    key = (settings["chat_id"], settings["msg_id"])
+    digest = _render_hash(text, reply_markup)
+    if _last_rendered.get(key) == digest:
+        return
 
     try:
-        await bot.edit_message_text(
+        await sender.edit_message_text(
             chat_id=settings["chat_id"],
             message_id=settings["msg_id"],
             text=text,
-            reply_markup=reply_markup
+            reply_markup=reply_markup,
+            priority=priority
         )
-    except Exception:
-        pass
+    except Exception as e:
+        _last_rendered.pop(key, None)
+        logging.warning("Не удалось обновить сообщение пользователя %s: %r", user_id, e)
+    else:
+        _remember_render(key, digest)
+        if priority == INTERACTIVE:
+            observe_visible()
 
 
 async def show_currency_selection(user_id: int):
     currencies, _ = await fetch_currencies()
     settings = await load_user_settings(user_id)
-    keyboard = await build_currency_keyboard(currencies, settings.get("selected", []))
+    keyboard = build_currency_keyboard(currencies, settings.get("selected", []))
     await recreate_dynamic_message(user_id, "Выберите валюты для отслеживания:", keyboard)
 
 
-async def show_rates(user_id: int):
-    currencies, rates = await fetch_currencies()
+async def show_rates(user_id: int, priority: int = INTERACTIVE):
+    snapshot = await rates_cache.get()
     settings = await load_user_settings(user_id)
 
     selected = settings.get("selected", [])
@@ -232,34 +217,141 @@ async def show_rates(user_id: int):
 
     if not base_currency or base_currency not in selected:
         base_currency = selected[0]
-        settings["base"] = base_currency
-        await save_user_settings(user_id, settings)
+        await set_base(user_id, base_currency)
 
-    tz_name = settings.get("timezone", "UTC")
+    tz_name = settings.get("timezone") or "UTC"
     tz = pytz.timezone(tz_name)
     now = datetime.now(pytz.utc).astimezone(tz)
 
     text = f"Курсы валют\nОбновлено: {now.strftime('%d.%m.%Y %H:%M:%S')}"
-    keyboard = await build_rates_keyboard(selected, base_currency, rates, amount)
-    await update_dynamic_message(user_id, text, keyboard)
+    if snapshot.is_stale():
+        # Источник недоступен, показываем последний сохранённый снимок
+        text += f"\n⚠️ Курсы ЦБ загружены {snapshot.age() / 3600:.0f} ч назад и могут быть устаревшими"
+    keyboard = build_rates_keyboard(selected, base_currency, snapshot, amount)
+    await update_dynamic_message(user_id, text, keyboard, priority)
+
+
+def schedule_show_rates(user_id: int) -> asyncio.Task:
+    # Первое нажатие отрисовывается сразу. Нажатия во время отрисовки и в окне
+    # RENDER_DEBOUNCE после неё склеиваются: в конце окна — одна отрисовка
+    # последнего состояния настроек
+    task = _pending_renders.get(user_id)
+    if task is None:
+        task = spawn_background(_debounced_show_rates(user_id))
+        _pending_renders[user_id] = task
+    else:
+        _rerender[user_id] = contextvars.copy_context()
+    return task
+
+
+def spawn_background(coro) -> asyncio.Task:
+    # Держим ссылку на задачу, иначе сборщик мусора может снять её на полпути
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def _record_history(snapshot):
+    if not snapshot.date:
+        return
+    day = datetime.fromisoformat(snapshot.date).date()
+    if day != _last_history_date:
+        spawn_background(_save_history(day, snapshot.rates))
+
+
+async def _save_history(day, rates: dict):
+    global _last_history_date
+    try:
+        inserted = await record_rate_snapshot(day, rates)
+    except Exception:
+        logging.exception("Не удалось сохранить историю курсов за %s", day)
+        return
+    _last_history_date = day
+    if inserted:
+        logging.info("История курсов: сохранён снимок за %s (%d валют)", day, inserted)
+
+
+def _check_alerts(snapshot):
+    fired = alert_index.evaluate(snapshot)
+    if fired:
+        spawn_background(_deliver_alerts(fired))
+
+
+async def _deliver_alerts(fired: list[tuple[Alert, float]]):
+    # Уведомления разовые: отправляем только те, что удалил этот процесс. Так они не придут
+    # снова после рестарта, а из нескольких реплик с одними и теми же уведомлениями отправит одна
+    try:
+        deleted = await delete_rate_alerts([alert.id for alert, _ in fired])
+    except Exception:
+        # Уведомления остались в БД и сработают при следующей загрузке
+        logging.exception("Не удалось удалить сработавшие уведомления")
+        return
+    logging.info("Сработало уведомлений о курсе: %d, отправляем %d", len(fired), len(deleted))
+    for alert, rate in fired:
+        if alert.id in deleted:
+            await alert_notifier.submit(alert, rate)
+
+
+async def load_alerts(shard: tuple[int, int] | None = None):
+    for data in await load_rate_alerts(shard):
+        alert_index.add(Alert.from_dict(data))
+    # Если снимок уже есть, проверяем по нему: пока бот был выключен, курс мог пересечь порог
+    if rates_cache.snapshot is not None:
+        _check_alerts(rates_cache.snapshot)
+
+
+def format_history(currency: str, days: list, weeks: list, months: list) -> str:
+    lines = [f"<b>{currency}</b> в рублях", "<pre>"]
+    lines.append("Дата        Курс")
+    for row in days:
+        lines.append(f"{row['period_start']:%d.%m.%Y}  {row['close']:.4f}")
+    for title, rows, fmt in (("Неделя", weeks, "%d.%m.%Y"), ("Месяц", months, "%m.%Y")):
+        lines.append("")
+        lines.append(f"{title:<10}  {'Средн.':>9} {'Мин.':>9} {'Макс.':>9}")
+        for row in rows:
+            lines.append(
+                f"{row['period_start'].strftime(fmt):<10}  {row['avg']:9.4f} {row['low']:9.4f} {row['high']:9.4f}"
+            )
+    lines.append("</pre>")
+    return "\n".join(lines)
+
+
+async def _debounced_show_rates(user_id: int):
+    try:
+        await _show_rates_logged(user_id)
+        while True:
+            await asyncio.sleep(RENDER_DEBOUNCE)
+            context = _rerender.pop(user_id, None)
+            if context is None:
+                return
+            # В контексте последнего нажатия: время до показа считается от него
+            await asyncio.create_task(_show_rates_logged(user_id), context=context)
+    finally:
+        _pending_renders.pop(user_id, None)
+        _rerender.pop(user_id, None)
+
+
+async def _show_rates_logged(user_id: int):
+    try:
+        await show_rates(user_id)
+    except Exception:
+        logging.exception("Не удалось показать курсы пользователю %s", user_id)
 
 
 @dp.message(CommandStart())
 async def start(message: types.Message):
-    await delete_user_message(message)
+    delete_user_message(message)
     user_id = message.from_user.id
 
-    settings = await load_user_settings(user_id)
-
-    settings.update({
-        "chat_id": message.chat.id,
-        "recent_amounts": [],
-        "amount": 1.0,
-        "msg_id": None,
-        "message_sent_at": None,
-    })
-
-    await save_user_settings(user_id, settings)
+    settings = await update_user_settings(
+        user_id,
+        chat_id=message.chat.id,
+        recent_amounts=[],
+        amount=1.0,
+        msg_id=None,
+        message_sent_at=None,
+    )
 
     selected = settings.get("selected", [])
 
@@ -275,20 +367,20 @@ async def start(message: types.Message):
 
 @dp.message(Command("restart"))
 async def restart(message: types.Message):
-    await delete_user_message(message)
+    delete_user_message(message)
     user_id = message.from_user.id
 
     # Полная очистка данных пользователя
-    settings = {
-        "chat_id": message.chat.id,
-        "recent_amounts": [],
-        "selected": [],
-        "base": None,
-        "amount": 1.0,
-        "msg_id": None,
-        "message_sent_at": None,
-    }
-    await save_user_settings(user_id, settings)
+    await update_user_settings(
+        user_id,
+        chat_id=message.chat.id,
+        recent_amounts=[],
+        selected=[],
+        base=None,
+        amount=1.0,
+        msg_id=None,
+        message_sent_at=None,
+    )
 
     # Отправляем приветственное сообщение с ReplyKeyboard
     await send_welcome_message(message.chat.id)
@@ -299,20 +391,109 @@ async def restart(message: types.Message):
 
 @dp.message(Command("refresh"))
 async def refresh(message: types.Message):
-    await delete_user_message(message)
+    delete_user_message(message)
 
     user_id = message.from_user.id
     await show_rates(user_id)
 
 
+@dp.message(Command("history"))
+async def history(message: types.Message, command: CommandObject):
+    delete_user_message(message)
+    currency = (command.args or "").strip().upper()
+    if not currency.isalpha() or len(currency) > 10:
+        await sender.send_message(chat_id=message.chat.id, text="Укажите валюту: /history USD")
+        return
+
+    days, weeks, months = await asyncio.gather(
+        get_rate_rollups(currency, "d", HISTORY_DAYS),
+        get_rate_rollups(currency, "w", HISTORY_WEEKS),
+        get_rate_rollups(currency, "m", HISTORY_MONTHS),
+    )
+    if not days:
+        await sender.send_message(chat_id=message.chat.id, text=f"Нет истории курса {currency}")
+        return
+
+    await sender.send_message(chat_id=message.chat.id, text=format_history(currency, days, weeks, months))
+
+
+@dp.message(Command("alert"))
+async def add_alert(message: types.Message, command: CommandObject):
+    delete_user_message(message)
+    user_id = message.from_user.id
+    parsed = parse_alert(command.args)
+    if parsed is None:
+        await sender.send_message(
+            chat_id=message.chat.id,
+            text="Формат: /alert USD &gt; 100 или /alert EUR &lt; 1.05 USD (по умолчанию в рублях)"
+        )
+        return
+
+    currency, direction, threshold, quote = parsed
+    snapshot = await rates_cache.get()
+    if currency not in snapshot.index or quote not in snapshot.index:
+        await sender.send_message(chat_id=message.chat.id, text="Неизвестная валюта")
+        return
+    if len(alert_index.user_alerts(user_id)) >= ALERTS_PER_USER:
+        await sender.send_message(
+            chat_id=message.chat.id, text=f"Не больше {ALERTS_PER_USER} уведомлений. Удалить: /unalert номер"
+        )
+        return
+
+    rate = snapshot.cross_rate(currency, quote)
+    if is_triggered(direction, rate, threshold):
+        await sender.send_message(
+            chat_id=message.chat.id, text=f"Условие уже выполнено: 1 {currency} = {rate:.4f} {quote}"
+        )
+        return
+
+    alert = Alert.from_dict(
+        await add_rate_alert(user_id, message.chat.id, currency, quote, direction, threshold)
+    )
+    alert_index.add(alert, rate)
+    await sender.send_message(
+        chat_id=message.chat.id,
+        text=f"Уведомлю, когда {format_alert(alert)}\nСейчас 1 {currency} = {rate:.4f} {quote}"
+    )
+
+
+@dp.message(Command("alerts"))
+async def list_alerts(message: types.Message):
+    delete_user_message(message)
+    alerts = alert_index.user_alerts(message.from_user.id)
+    if not alerts:
+        await sender.send_message(chat_id=message.chat.id, text="Уведомлений нет. Добавить: /alert USD &gt; 100")
+        return
+    lines = [f"{alert.id}: {format_alert(alert)}" for alert in alerts]
+    lines.append("Удалить: /unalert номер")
+    await sender.send_message(chat_id=message.chat.id, text="\n".join(lines))
+
+
+@dp.message(Command("unalert"))
+async def remove_alert(message: types.Message, command: CommandObject):
+    delete_user_message(message)
+    args = (command.args or "").strip()
+    if not args.isdigit():
+        await sender.send_message(chat_id=message.chat.id, text="Укажите номер из /alerts: /unalert 12")
+        return
+
+    alert_id = int(args)
+    if await delete_rate_alerts([alert_id], user_id=message.from_user.id):
+        alert_index.remove(alert_id)
+        await sender.send_message(chat_id=message.chat.id, text="Уведомление удалено")
+    else:
+        await sender.send_message(chat_id=message.chat.id, text="Такого уведомления нет")
+
+
 @dp.message(Command("setting"))
 async def settings_menu(message: types.Message):
-    await delete_user_message(message)
+    delete_user_message(message)
     user_id = message.from_user.id
 
     keyboard = InlineKeyboardBuilder()
     keyboard.button(text="🌐 Настроить часовой пояс", callback_data="set_timezone")
     keyboard.button(text="💱 Настроить валюты", callback_data="set_currencies")
+    keyboard.button(text="🔁 Автообновление курсов", callback_data="set_policy")
     keyboard.adjust(1)
 
     settings = await load_user_settings(user_id)
@@ -323,36 +504,98 @@ async def settings_menu(message: types.Message):
     )
 
 
-@dp.message()
-async def handle_user_message(message: types.Message):
-    user_id = message.from_user.id
-    text = message.text.strip()
-
-    settings = await load_user_settings(user_id)
-
+def parse_amount_change(text: str):
+    # Текст с клавиатуры -> функция от текущей суммы; None — если это не сумма
     try:
         if text.startswith("+"):
             delta = float(text[1:])
-            settings["amount"] += delta
+            return lambda amount: amount + delta
         elif text.startswith("×") or text.startswith("*"):
             factor = float(text[1:])
-            settings["amount"] *= factor
+            return lambda amount: amount * factor
         elif text.startswith("/") or text.startswith("÷"):
             divisor = float(text[1:])
-            settings["amount"] /= divisor
+            if divisor == 0:
+                return None
+            return lambda amount: amount / divisor
         elif text in ("🔄", "сброс", "сбросить"):
-            settings["amount"] = 1.0
+            return lambda amount: 1.0
         else:
-            amount = float(text.replace(",", "."))
-            settings["amount"] = amount
-    except Exception:
-        await delete_user_message(message)
+            value = float(text.replace(",", "."))
+            return lambda amount: value
+    except ValueError:
+        return None
+
+
+def is_absolute_amount(text: str) -> bool:
+    # Сумма целиком («250», сброс), а не изменение текущей (+10, ×2)
+    return not text.startswith(("+", "×", "*", "/", "÷")) and parse_amount_change(text) is not None
+
+
+def _supersede_kind(update: types.Update) -> str | None:
+    # Абсолютные изменения: из нескольких подряд в очереди пользователя выполняется последнее.
+    # Относительные (+10) не пропускаются никогда — иначе потеряется сумма
+    if update.message is not None and update.message.text:
+        return "amount" if is_absolute_amount(update.message.text.strip()) else None
+    if update.callback_query is not None and (update.callback_query.data or "").startswith("base_"):
+        return "base"
+    return None
+
+
+async def _on_superseded(message: types.Message):
+    # Пропущенная сумма с клавиатуры всё равно не должна остаться в чате
+    delete_user_message(message)
+
+
+@dp.message()
+async def handle_user_message(message: types.Message):
+    user_id = message.from_user.id
+    text = message.text.strip()
+
+    change = parse_amount_change(text)
+    if change is None:
+        delete_user_message(message)
         return
 
-    await save_user_settings(user_id, settings)
-    await show_rates(user_id)
+    # Изменение применяется к актуальной сумме: два быстрых «+10» дадут +20
+    await change_amount(user_id, change)
+    schedule_show_rates(user_id)
+
+    delete_user_message(message)
+
+
+async def _warm_settings(user_id: int):
+    try:
+        await load_user_settings(user_id)
+    except Exception as e:
+        logging.debug("Не удалось загрузить настройки пользователя %s: %r", user_id, e)
+    finally:
+        _settings_warmups.discard(user_id)
+
+
+@dp.inline_query()
+async def inline_conversion(inline_query: types.InlineQuery):
+    # Запрос приходит на каждое нажатие клавиши: ответ только из памяти
+    user_id = inline_query.from_user.id
+    snapshot = rates_cache.snapshot or rates_cache.restore()
+    if snapshot is None:
+        spawn_background(prefetch_rates())
+        await inline_query.answer([], cache_time=0, is_personal=True)
+        return
 
-    await delete_user_message(message)
+    settings = peek_user_settings(user_id)
+    if settings is None and user_id not in _settings_warmups:
+        # Подгружаем настройки в кэш для следующих нажатий, этот ответ — с валютами по умолчанию
+        _settings_warmups.add(user_id)
+        spawn_background(_warm_settings(user_id))
+    # get() сразу отдаёт текущий снимок и при необходимости обновляет его в фоне
+    snapshot = await rates_cache.get()
+    results = build_inline_results(inline_query.query, settings, snapshot)
+    await inline_query.answer(
+        results,
+        cache_time=inline_cache_time(snapshot, rates_cache.ttl) if settings is not None else 0,
+        is_personal=True,
+    )
 
 
 @dp.callback_query(F.data == "set_timezone")
@@ -373,7 +616,8 @@ async def show_timezone_selection(callback: types.CallbackQuery):
             offset_str = f"UTC{sign}{hours}" if minutes == 0 else f"UTC{sign}{hours}:{minutes:02}"
             display_name = f"{tz_name} ({offset_str})"
             keyboard.button(text=display_name, callback_data=f"timezone_{tz_name}")
-        except Exception:
+        except Exception as e:
+            logging.warning("Пропускаю часовой пояс %s: %r", tz_name, e)
             continue
 
     keyboard.adjust(1)
@@ -389,10 +633,8 @@ async def show_timezone_selection(callback: types.CallbackQuery):
 async def set_user_timezone(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     timezone = callback.data.replace("timezone_", "")
+    await set_timezone(user_id, timezone)
     settings = await load_user_settings(user_id)
-
-    settings["timezone"] = timezone
-    await save_user_settings(user_id, settings)
     selected = settings.get("selected", [])
 
     if selected:
@@ -401,6 +643,35 @@ async def set_user_timezone(callback: types.CallbackQuery):
         await show_currency_selection(user_id)
 
 
+@dp.callback_query(F.data == "set_policy")
+async def show_refresh_policies(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    settings = await load_user_settings(user_id)
+
+    keyboard = InlineKeyboardBuilder()
+    for policy, title in REFRESH_POLICIES.items():
+        mark = "✅" if settings.get("refresh_policy") == policy else "▫️"
+        keyboard.button(text=f"{mark} {title}", callback_data=f"policy_{policy}")
+    keyboard.adjust(1)
+
+    await update_dynamic_message(user_id, "Когда обновлять сообщение с курсами?", keyboard.as_markup())
+
+
+@dp.callback_query(F.data.startswith("policy_"))
+async def set_user_refresh_policy(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    policy = callback.data.replace("policy_", "")
+    if policy not in REFRESH_POLICIES:
+        return
+    await set_refresh_policy(user_id, policy)
+    settings = await load_user_settings(user_id)
+
+    if settings.get("selected"):
+        await show_rates(user_id)
+    else:
+        await show_currency_selection(user_id)
+
+
 @dp.callback_query(F.data == "set_currencies")
 async def show_currency_config(callback: types.CallbackQuery):
     user_id = callback.from_user.id
@@ -414,17 +685,9 @@ async def back_to_selection(callback: types.CallbackQuery):
 
     currencies, _ = await fetch_currencies()
     selected = settings.get("selected", [])
-    keyboard = await build_currency_keyboard(currencies, selected)
+    keyboard = build_currency_keyboard(currencies, selected)
 
-    try:
-        await bot.edit_message_text(
-            chat_id=settings["chat_id"],
-            message_id=settings["msg_id"],
-            text="Выберите валюты для отслеживания:",
-            reply_markup=keyboard
-        )
-    except Exception:
-        pass
+    await update_dynamic_message(user_id, "Выберите валюты для отслеживания:", keyboard)
 
 
 @dp.callback_query(F.data == "show_rates")
@@ -438,42 +701,28 @@ async def select_currency(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     currency = callback.data.replace("select_", "")
 
-    settings = await load_user_settings(user_id)
-    selected = settings.get("selected", [])
-
-    if currency in selected:
-        selected.remove(currency)
-    else:
-        selected.append(currency)
-        if len(selected) == 1:
-            settings["base"] = currency
-
-    settings["selected"] = selected
-    await save_user_settings(user_id, settings)
+    settings = await toggle_selected(user_id, currency)
+    selected = settings["selected"]
 
     # Обновляем текущее сообщение, не удаляя его
     currencies, _ = await fetch_currencies()
-    keyboard = await build_currency_keyboard(currencies, selected)
+    keyboard = build_currency_keyboard(currencies, selected)
 
-    try:
-        await bot.edit_message_text(
-            chat_id=settings["chat_id"],
-            message_id=settings["msg_id"],
-            text="Выберите валюты для отслеживания:",
-            reply_markup=keyboard
-        )
-    except Exception:
-        pass
+    await update_dynamic_message(user_id, "Выберите валюты для отслеживания:", keyboard)
 
 
 @dp.callback_query(F.data.startswith("base_"))
 async def change_base_currency(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     currency = callback.data.replace("base_", "")
-    settings = await load_user_settings(user_id)
-    settings["base"] = currency
-    await save_user_settings(user_id, settings)
-    await show_rates(user_id)
+    await set_base(user_id, currency)
+    schedule_show_rates(user_id)
+
+
+@dp.callback_query()
+async def unknown_callback(callback: types.CallbackQuery):
+    # Кнопка из старой версии бота: на нажатие уже ответил CallbackAckMiddleware
+    logging.debug("Неизвестный callback от %s: %r", callback.from_user.id, callback.data)
 
 
 async def set_commands(bot: Bot):
@@ -481,38 +730,178 @@ async def set_commands(bot: Bot):
         types.BotCommand(command="restart", description="Перезапустить бота"),
         types.BotCommand(command="refresh", description="Обновить курсы валют"),
         types.BotCommand(command="setting", description="Настройки"),
+        types.BotCommand(command="history", description="История курса: /history USD"),
+        types.BotCommand(command="alert", description="Уведомить о курсе: /alert USD > 100"),
+        types.BotCommand(command="alerts", description="Мои уведомления о курсе"),
     ]
     await bot.set_my_commands(commands)
 
 
-async def periodic_update_all_users():
+def rates_changed(settings: dict, previous, snapshot) -> bool:
+    # Изменилось ли хоть одно значение на кнопках пользователя
+    selected = settings.get("selected") or []
+    if not selected:
+        return False
+    base = settings.get("base")
+    if not base or base not in selected:
+        base = selected[0]
+    if any(code not in previous.index or code not in snapshot.index for code in selected):
+        return True
+    amount = settings.get("amount", 1.0)
+    return rates_values(selected, base, previous, amount) != rates_values(selected, base, snapshot, amount)
+
+
+def changed_currencies(previous, snapshot) -> set[str]:
+    # Валюты, курс которых к рублю изменился, появился или пропал
+    return {
+        code for code in previous.rates.keys() | snapshot.rates.keys()
+        if previous.rates.get(code) != snapshot.rates.get(code)
+    }
+
+
+def _on_new_snapshot(snapshot):
+    previous = rates_cache.previous_snapshot
+    # Без предыдущего снимка (первый запуск без файла снимка) неизвестно, что видят пользователи
+    if previous is None:
+        return
+    if (snapshot.date, snapshot.previous_date) == (previous.date, previous.previous_date):
+        return
+    spawn_background(push_publication(previous, snapshot, _shard))
+
+
+async def _refresh_worker(queue: asyncio.Queue, stats: dict):
     while True:
-        await asyncio.sleep(7200)
+        user_id = await queue.get()
+        try:
+            await show_rates(user_id, priority=BACKGROUND)
+            stats["updated"] += 1
+        except Exception:
+            stats["failed"] += 1
+            logging.exception("Не удалось обновить курсы для пользователя %s", user_id)
+        finally:
+            queue.task_done()
 
-        users = await get_all_users()
-        now = datetime.now()
 
-        for user in users:
-            user_id = user["user_id"]
-            settings = await load_user_settings(user_id)
+async def push_publication(previous, snapshot, shard: tuple[int, int] | None = None):
+    # Новая публикация ЦБ: правим сообщения только тем, у кого это что-то меняет
+    started = time.monotonic()
+    stats = {"updated": 0, "failed": 0, "unchanged": 0}
 
-            last_update = settings.get("message_sent_at")
-            if not last_update:
-                continue
+    queue = asyncio.Queue(maxsize=REFRESH_WORKERS * 4)
+    workers = [asyncio.create_task(_refresh_worker(queue, stats)) for _ in range(REFRESH_WORKERS)]
+    try:
+        # Кнопки могут измениться, только если среди выбранных валют есть изменившаяся
+        async for batch in iter_refresh_candidates(REFRESH_BATCH, shard, changed_currencies(previous, snapshot)):
+            for user_id, settings in batch:
+                if settings.get("refresh_policy") == "changes" and not rates_changed(settings, previous, snapshot):
+                    stats["unchanged"] += 1
+                    continue
+                await queue.put(user_id)
+        await queue.join()
+    finally:
+        for worker in workers:
+            worker.cancel()
+
+    elapsed = time.monotonic() - started
+    logging.info(
+        "Публикация ЦБ %s: %d обновлено, %d без изменений, %d с ошибкой за %.1f с",
+        snapshot.date, stats["updated"], stats["unchanged"], stats["failed"], elapsed
+    )
 
-            if isinstance(last_update, str):
-                last_update = datetime.fromisoformat(last_update)
 
-            if (now - last_update).total_seconds() > 7200:
-                await show_rates(user_id)
+async def watch_rates():
+    # Регулярно спрашиваем источник; новая публикация сама запустит push_publication
+    while True:
+        await asyncio.sleep(RATES_POLL_INTERVAL)
+        try:
+            await rates_cache.refresh()
+        except Exception as e:
+            logging.warning("Не удалось проверить публикацию курсов: %r", e)
+
+
+_metrics_runner = None
+
+
+async def _timed_step(name: str, step):
+    started = time.monotonic()
+    try:
+        await step
+    finally:
+        STARTUP_STEP_SECONDS.labels(name).set(time.monotonic() - started)
+
+
+async def warm_up(**steps):
+    # Шаги запуска независимы и идут параллельно: warm_up(schema=init_db(), rates=prefetch_rates())
+    await asyncio.gather(*(_timed_step(name, step) for name, step in steps.items()))
+
+
+async def prefetch_rates():
+    # Если на диске есть последний снимок, get() отдаёт его сразу и обновляет в фоне.
+    # Без курсов бот всё равно запустится: первый запрос пользователя попробует их загрузить снова
+    try:
+        await rates_cache.get()
+    except Exception as e:
+        logging.warning("Не удалось загрузить курсы при запуске: %r", e)
+
+
+async def start_background_services(shard: tuple[int, int] | None = None) -> list[asyncio.Task]:
+    global _metrics_runner, _shard
+    _shard = shard
+    instrument_engine(db.get_engine())
+    register_cache("settings", db.settings_cache)
+    register_cache("rates_keyboard", rates_keyboard_cache)
+    register_cache("currency_keyboard", currency_keyboard_cache)
+    register_sender(sender)
+    register_background(callback_tasks)
+    register_admission(admission)
+    sender.start(get_bot())
+    alert_notifier.start()
+    if METRICS_PORT:
+        # У каждого воркера свой порт: METRICS_PORT + 1 + номер воркера
+        _metrics_runner = await start_metrics_server(METRICS_PORT + (shard[0] + 1 if shard else 0))
+    return [
+        asyncio.create_task(watch_rates()),
+        asyncio.create_task(run_settings_flusher()),
+    ]
+
+
+async def stop_background_services(tasks: list[asyncio.Task]):
+    for task in tasks:
+        task.cancel()
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+    await callback_tasks.stop()
+    await alert_notifier.stop()
+    await sender.stop()
+    await close_db()
+    await rates_cache.close()
 
 
 async def main():
-    await init_db()
-    await set_commands(bot)
-    asyncio.create_task(periodic_update_all_users())
-    await dp.start_polling(bot)
+    bot = get_bot()
+    if WORKER_PROCESSES > 0:
+        # Этот процесс только принимает апдейты и раздаёт их воркерам; курсы грузят сами воркеры
+        await warm_up(schema=init_db(), commands=set_commands(bot))
+        await run_sharded(bot, dp, WORKER_PROCESSES, BOT_MODE)
+        return
+
+    # Сервер метрик поднимается первым: /readyz отвечает 503, пока идёт прогрев
+    tasks = await start_background_services()
+    try:
+        await warm_up(schema=init_db(), commands=set_commands(bot), rates=prefetch_rates())
+        # Таблица уведомлений появляется на шаге schema
+        await _timed_step("alerts", load_alerts())
+        mark_ready()
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot)
+        else:
+            # getUpdates не работает, пока у бота зарегистрирован вебхук
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        await stop_background_services(tasks)
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     asyncio.run(main())
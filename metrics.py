@@ -0,0 +1,232 @@
+import logging
+import os
+import time
+from contextvars import ContextVar
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from sqlalchemy import event
+
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — эндпоинт /metrics выключен
+TRACE_UPDATES = os.getenv("TRACE_UPDATES", "0") == "1"  # по строке лога на каждый апдейт
+
+logger = logging.getLogger(__name__)
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время работы обработчика", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в обработчиках", ["handler", "error"])
+UPDATES = Counter("bot_updates_total", "Входящие апдейты", ["type"])
+
+DB_QUERIES = Counter("bot_db_queries_total", "SQL-запросы", ["statement"])
+DB_QUERY_SECONDS = Histogram(
+    "bot_db_query_seconds", "Время SQL-запроса", ["statement"],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5),
+)
+DB_POOL = Gauge("bot_db_pool_connections", "Соединения пула БД", ["state"])
+
+TELEGRAM_SECONDS = Histogram("bot_telegram_request_seconds", "Время запроса к Bot API", ["method"])
+TELEGRAM_ERRORS = Counter("bot_telegram_errors_total", "Ошибки Bot API", ["method", "error"])
+
+RATE_FETCH_SECONDS = Histogram("bot_rate_fetch_seconds", "Время загрузки курсов", ["provider"])
+RATE_FETCH_ERRORS = Counter("bot_rate_fetch_errors_total", "Неудачные обновления курсов")
+
+CACHE_REQUESTS = Gauge("bot_cache_requests", "Обращения к кэшам с момента старта", ["cache", "result"])
+SENDER_QUEUE = Gauge("bot_sender_queue_depth", "Запросы в очереди отправки", ["priority"])
+
+TAP_TO_VISIBLE_SECONDS = Histogram(
+    "bot_tap_to_visible_seconds", "От нажатия кнопки до правки сообщения", ["handler"],
+    buckets=(.05, .1, .25, .5, .75, 1, 1.5, 2, 3, 5, 10),
+)
+BACKGROUND_ERRORS = Counter("bot_background_errors_total", "Ошибки фоновых задач", ["task", "error"])
+BACKGROUND_PENDING = Gauge("bot_background_pending", "Фоновые задачи в очереди и в работе")
+ADMISSION_SHED = Counter("bot_admission_shed_total", "Апдейты, отброшенные при приёме", ["reason"])
+ADMISSION = Gauge("bot_admission_updates", "Принятые апдейты", ["state"])
+
+# Шардирование: собирает фронт-процесс по отчётам воркеров
+SHARD_UPDATES = Gauge("bot_shard_updates", "Апдейты воркера с момента старта", ["worker", "result"])
+SHARD_QUEUE = Gauge("bot_shard_queue_depth", "Апдейты, ждущие воркера", ["worker", "stage"])
+SHARD_THROUGHPUT = Gauge("bot_shard_throughput", "Апдейтов в секунду за последний интервал", ["worker"])
+SHARD_ACTIVE_USERS = Gauge("bot_shard_active_users", "Пользователи с апдейтами в работе", ["worker"])
+
+STARTUP_STEP_SECONDS = Gauge("bot_startup_step_seconds", "Длительность шагов запуска", ["step"])
+TIME_TO_READY = Gauge("bot_time_to_ready_seconds", "От импорта модулей бота до готовности обслуживать")
+READY = Gauge("bot_ready", "1 — бот готов обслуживать апдейты")
+
+# Отсчёт времени до готовности: metrics импортируется в самом начале запуска
+_started_at = time.monotonic()
+_ready = False
+
+# Текущий апдейт для трассировки: счётчики запросов к БД и Bot API внутри него
+_span: ContextVar[dict | None] = ContextVar("bot_update_span", default=None)
+
+# Нажатие, результат которого пользователь ещё не увидел: (обработчик, время получения)
+_tap: ContextVar[tuple[str, float] | None] = ContextVar("bot_tap", default=None)
+
+
+def start_tap(handler: str):
+    _tap.set((handler, time.perf_counter()))
+
+
+def observe_visible():
+    # Вызывается, когда правка сообщения дошла до Telegram; одно наблюдение на нажатие
+    tap = _tap.get()
+    if tap is not None:
+        TAP_TO_VISIBLE_SECONDS.labels(tap[0]).observe(time.perf_counter() - tap[1])
+        _tap.set(None)
+
+
+def _span_incr(key: str):
+    span = _span.get()
+    if span is not None:
+        span[key] += 1
+
+
+def _statement_kind(statement: str) -> str:
+    return statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+
+
+def instrument_engine(engine):
+    # engine — AsyncEngine; события SQLAlchemy вешаются на синхронный движок под ним
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_start"].pop()
+        kind = _statement_kind(statement)
+        DB_QUERIES.labels(kind).inc()
+        DB_QUERY_SECONDS.labels(kind).observe(time.perf_counter() - started)
+        _span_incr("db")
+
+    pool = sync_engine.pool
+    # У пулов без очереди (например, у SQLite) этих счётчиков нет
+    if hasattr(pool, "checkedout"):
+        DB_POOL.labels("size").set_function(pool.size)
+        DB_POOL.labels("checked_out").set_function(pool.checkedout)
+        DB_POOL.labels("idle").set_function(pool.checkedin)
+        # overflow() отрицателен, пока пул не заполнен до size
+        DB_POOL.labels("overflow").set_function(lambda: max(pool.overflow(), 0))
+
+
+def register_cache(name: str, cache):
+    # cache — любой объект со счётчиками hits и misses
+    CACHE_REQUESTS.labels(name, "hit").set_function(lambda: cache.hits)
+    CACHE_REQUESTS.labels(name, "miss").set_function(lambda: cache.misses)
+
+
+def register_background(queue):
+    BACKGROUND_PENDING.set_function(queue.pending)
+
+
+def register_admission(control):
+    ADMISSION.labels("in_flight").set_function(lambda: control.in_flight)
+    ADMISSION.labels("waiting").set_function(control.waiting)
+
+
+def register_sender(sender):
+    for name in sender.queue_depth():
+        SENDER_QUEUE.labels(name).set_function(lambda name=name: sender.queue_depth()[name])
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # Внутренний middleware: известен конкретный обработчик, которому достался апдейт
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        span = _span.get()
+        if span is not None:
+            span["handler"] = name
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            HANDLER_ERRORS.labels(name, type(e).__name__).inc()
+            raise
+        finally:
+            HANDLER_SECONDS.labels(name).observe(time.perf_counter() - started)
+
+
+class UpdateTraceMiddleware(BaseMiddleware):
+    # Внешний middleware на апдейт: считает апдейты и при TRACE_UPDATES пишет спан в лог
+
+    async def __call__(self, handler, event, data):
+        UPDATES.labels(event.event_type).inc()
+        if not TRACE_UPDATES:
+            return await handler(event, data)
+
+        span = {"db": 0, "api": 0, "handler": None}
+        token = _span.set(span)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            _span.reset(token)
+            user = data.get("event_from_user")
+            logger.info(
+                "trace update=%s type=%s user=%s handler=%s %.1f ms db=%d api=%d",
+                event.update_id, event.event_type, user.id if user else None, span["handler"],
+                (time.perf_counter() - started) * 1000, span["db"], span["api"]
+            )
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_ERRORS.labels(name, type(e).__name__).inc()
+            raise
+        finally:
+            TELEGRAM_SECONDS.labels(name).observe(time.perf_counter() - started)
+            _span_incr("api")
+
+
+def mark_ready():
+    global _ready
+    _ready = True
+    elapsed = time.monotonic() - _started_at
+    TIME_TO_READY.set(elapsed)
+    READY.set(1)
+    logger.info("Бот готов к работе через %.2f с после запуска", elapsed)
+
+
+def is_ready() -> bool:
+    return _ready
+
+
+async def _metrics_handler(_request: web.Request) -> web.Response:
+    response = web.Response(body=generate_latest())
+    response.content_type = CONTENT_TYPE_LATEST.split(";")[0]
+    response.charset = "utf-8"
+    return response
+
+
+async def _readyz_handler(_request: web.Request) -> web.Response:
+    if is_ready():
+        return web.Response(text="ok")
+    return web.Response(status=503, text="starting")
+
+
+def build_metrics_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_handler)
+    app.router.add_get("/readyz", _readyz_handler)
+    return app
+
+
+async def start_metrics_server(port: int = METRICS_PORT, host: str = METRICS_HOST) -> web.AppRunner | None:
+    if not port:
+        return None
+    runner = web.AppRunner(build_metrics_app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Метрики доступны на %s:%s/metrics", host, port)
+    return runner
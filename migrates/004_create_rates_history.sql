@@ -0,0 +1,21 @@
+CREATE TABLE IF NOT EXISTS rates_history (
+    currency VARCHAR(10) NOT NULL,
+    date DATE NOT NULL,
+    value DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (currency, date)
+);
+
+CREATE TABLE IF NOT EXISTS rates_rollups (
+    currency VARCHAR(10) NOT NULL,
+    period CHAR(1) NOT NULL,
+    period_start DATE NOT NULL,
+    open DOUBLE PRECISION NOT NULL,
+    open_date DATE NOT NULL,
+    close DOUBLE PRECISION NOT NULL,
+    close_date DATE NOT NULL,
+    high DOUBLE PRECISION NOT NULL,
+    low DOUBLE PRECISION NOT NULL,
+    total DOUBLE PRECISION NOT NULL,
+    samples INTEGER NOT NULL,
+    PRIMARY KEY (currency, period, period_start)
+);
@@ -0,0 +1,2 @@
+DROP TABLE IF EXISTS rates_rollups;
+DROP TABLE IF EXISTS rates_history;
@@ -0,0 +1,10 @@
+ALTER TABLE user_settings
+    ALTER COLUMN selected DROP DEFAULT,
+    ALTER COLUMN selected TYPE JSONB USING COALESCE(NULLIF(selected, ''), '[]')::jsonb,
+    ALTER COLUMN selected SET DEFAULT '[]'::jsonb,
+    ALTER COLUMN recent_amounts DROP DEFAULT,
+    ALTER COLUMN recent_amounts TYPE JSONB USING COALESCE(NULLIF(recent_amounts, ''), '[]')::jsonb,
+    ALTER COLUMN recent_amounts SET DEFAULT '[]'::jsonb;
+
+CREATE INDEX IF NOT EXISTS idx_user_settings_selected
+ON user_settings USING GIN (selected jsonb_path_ops);
@@ -0,0 +1,9 @@
+DROP INDEX IF EXISTS idx_user_settings_selected;
+
+ALTER TABLE user_settings
+    ALTER COLUMN selected DROP DEFAULT,
+    ALTER COLUMN selected TYPE TEXT USING selected::text,
+    ALTER COLUMN selected SET DEFAULT '[]',
+    ALTER COLUMN recent_amounts DROP DEFAULT,
+    ALTER COLUMN recent_amounts TYPE TEXT USING recent_amounts::text,
+    ALTER COLUMN recent_amounts SET DEFAULT '[]';
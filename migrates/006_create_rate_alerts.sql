@@ -0,0 +1,12 @@
+CREATE TABLE IF NOT EXISTS rate_alerts (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    chat_id BIGINT NOT NULL,
+    currency VARCHAR(10) NOT NULL,
+    quote VARCHAR(10) NOT NULL DEFAULT 'RUB',
+    direction CHAR(1) NOT NULL,
+    threshold DOUBLE PRECISION NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS ix_rate_alerts_user_id ON rate_alerts (user_id);
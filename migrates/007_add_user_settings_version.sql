@@ -0,0 +1,2 @@
+ALTER TABLE user_settings
+ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
@@ -0,0 +1,2 @@
+ALTER TABLE user_settings
+DROP COLUMN IF EXISTS version;
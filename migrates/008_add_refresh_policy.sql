@@ -0,0 +1,6 @@
+ALTER TABLE user_settings
+ADD COLUMN IF NOT EXISTS refresh_policy VARCHAR(16) NOT NULL DEFAULT 'changes';
+
+CREATE INDEX IF NOT EXISTS idx_user_settings_refresh
+ON user_settings (user_id)
+WHERE msg_id IS NOT NULL AND refresh_policy <> 'off';
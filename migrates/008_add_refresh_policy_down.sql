@@ -0,0 +1,4 @@
+DROP INDEX IF EXISTS idx_user_settings_refresh;
+
+ALTER TABLE user_settings
+DROP COLUMN IF EXISTS refresh_policy;
@@ -0,0 +1,176 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+import aiohttp
+
+CURRENCY_URL = os.getenv("CURRENCY_URL", "https://www.cbr-xml-daily.ru/daily_json.js")
+RATES_MIRROR_URL = os.getenv("RATES_MIRROR_URL")  # зеркало в том же формате, что и daily_json.js
+RATES_FILE = os.getenv("RATES_FILE")  # локальный JSON в формате ЦБ: последний резерв и тесты
+
+RATES_TIMEOUT = float(os.getenv("RATES_TIMEOUT", "10"))
+RATES_HEDGE_DELAY = float(os.getenv("RATES_HEDGE_DELAY", "1.5"))  # бюджет ожидания до запроса к следующему источнику
+BREAKER_FAILURES = int(os.getenv("RATES_BREAKER_FAILURES", "3"))
+BREAKER_RESET = float(os.getenv("RATES_BREAKER_RESET", "60"))  # секунды до пробного запроса
+
+logger = logging.getLogger(__name__)
+
+
+class RatesUnavailable(Exception):
+    pass
+
+
+class RateProvider:
+    # Источник курсов: возвращает словарь в формате daily_json.js ЦБ
+    name = "provider"
+
+    async def fetch(self) -> dict:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class HttpJsonProvider(RateProvider):
+    def __init__(self, name: str, url: str, timeout: float = RATES_TIMEOUT):
+        self.name = name
+        self.url = url
+        self.timeout = timeout
+        self._session: aiohttp.ClientSession | None = None
+
+    async def fetch(self) -> dict:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        async with self._session.get(self.url) as response:
+            response.raise_for_status()
+            # ЦБ отдаёт JSON с content-type application/javascript
+            return await response.json(content_type=None)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+class FileProvider(RateProvider):
+    def __init__(self, path: str, name: str = "file"):
+        self.name = name
+        self.path = path
+
+    async def fetch(self) -> dict:
+        return await asyncio.to_thread(self._read)
+
+    def _read(self) -> dict:
+        with open(self.path, encoding="utf-8") as f:
+            return json.load(f)
+
+
+class CircuitBreaker:
+    # После failure_threshold ошибок подряд источник пропускается reset_timeout секунд,
+    # затем пропускается один пробный запрос
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURES, reset_timeout: float = BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        return self.state != "open"
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            # В half_open неудачная проба снова открывает выключатель на полный срок
+            self.opened_at = time.monotonic()
+
+
+class HedgedRateSource:
+    # Опрашивает источники по приоритету. Если текущий не ответил за hedge_delay,
+    # параллельно запрашивается следующий; побеждает первый удачный ответ.
+
+    def __init__(self, providers: list[RateProvider], hedge_delay: float = RATES_HEDGE_DELAY):
+        self.providers = providers
+        self.hedge_delay = hedge_delay
+        self.breakers = {provider.name: CircuitBreaker() for provider in providers}
+
+    async def fetch(self) -> tuple[dict, str]:
+        candidates = [provider for provider in self.providers if self.breakers[provider.name].allow()]
+        if not candidates:
+            raise RatesUnavailable("все источники курсов отключены выключателем")
+
+        tasks: dict[asyncio.Task, RateProvider] = {}
+        errors = []
+
+        def launch():
+            provider = candidates[len(tasks)]
+            tasks[asyncio.create_task(self._attempt(provider))] = provider
+
+        launch()
+        pending = set(tasks)
+        try:
+            while pending:
+                can_hedge = len(tasks) < len(candidates)
+                done, pending = await asyncio.wait(
+                    pending, timeout=self.hedge_delay if can_hedge else None, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    logger.info("Источник %s не уложился в %.1f с, запрашиваем следующий",
+                                tasks[next(iter(pending))].name, self.hedge_delay)
+                    launch()
+                    pending = {task for task in tasks if not task.done()}
+                    continue
+
+                for task in done:
+                    if task.exception() is None:
+                        return task.result(), tasks[task].name
+                    errors.append(f"{tasks[task].name}: {task.exception()!r}")
+
+                if len(tasks) < len(candidates):
+                    # Источник ответил ошибкой — не ждём бюджет, сразу идём к следующему
+                    launch()
+                    pending = {task for task in tasks if not task.done()}
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+        raise RatesUnavailable("; ".join(errors))
+
+    async def _attempt(self, provider: RateProvider) -> dict:
+        breaker = self.breakers[provider.name]
+        try:
+            data = await provider.fetch()
+            if "Valute" not in data:
+                raise ValueError("в ответе нет Valute")
+        except Exception:
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return data
+
+    async def close(self):
+        for provider in self.providers:
+            await provider.close()
+
+
+def default_providers() -> list[RateProvider]:
+    providers = [HttpJsonProvider("cbr", CURRENCY_URL)]
+    if RATES_MIRROR_URL:
+        providers.append(HttpJsonProvider("mirror", RATES_MIRROR_URL))
+    if RATES_FILE:
+        providers.append(FileProvider(RATES_FILE))
+    return providers
@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    # Классический token bucket: rate токенов в секунду, не больше capacity про запас
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self) -> float:
+        # Сколько ждать до появления токена (0 — можно прямо сейчас)
+        self._refill()
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def try_take(self) -> bool:
+        if self.delay() > 0:
+            return False
+        self._tokens -= 1
+        return True
+
+    async def acquire(self):
+        while not self.try_take():
+            await asyncio.sleep(self.delay())
+
+
+class KeyedTokenBuckets:
+    # Отдельный bucket на каждый ключ (например, chat_id); простаивающие удаляются
+
+    def __init__(self, rate: float, capacity: float | None = None, idle_ttl: float = 300):
+        self.rate = rate
+        self.capacity = capacity
+        self.idle_ttl = idle_ttl
+        self._buckets: dict = {}
+        self._last_gc = time.monotonic()
+
+    def get(self, key) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            self._gc()
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+        return bucket
+
+    def _gc(self):
+        now = time.monotonic()
+        if now - self._last_gc < self.idle_ttl:
+            return
+        self._last_gc = now
+        self._buckets = {
+            key: bucket for key, bucket in self._buckets.items()
+            if now - bucket._updated < self.idle_ttl
+        }
+
+    def __len__(self):
+        return len(self._buckets)
@@ -0,0 +1,249 @@
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from metrics import RATE_FETCH_ERRORS, RATE_FETCH_SECONDS
+from providers import HedgedRateSource, default_providers
+
+RATES_TTL = float(os.getenv("RATES_TTL", "600"))  # секунды, сколько снимок считается свежим
+RATES_RETRY_INTERVAL = float(os.getenv("RATES_RETRY_INTERVAL", "30"))  # пауза после неудачного обновления
+# Последний удачный снимок на диске: тёплый старт и работа, пока ЦБ недоступен
+RATES_SNAPSHOT_FILE = os.getenv("RATES_SNAPSHOT_FILE", "data/rates_snapshot.bin")
+RATES_STALE_AFTER = float(os.getenv("RATES_STALE_AFTER", "3600"))  # секунды, после которых курсы помечаются устаревшими
+
+# Файл снимка: заголовок, строки date/previous_date/provider, выравнивание до 8 байт,
+# коды валют по 8 байт, опубликованные Value (float64) и Nominal (uint32) в том же порядке
+SNAPSHOT_MAGIC = b"CBRS"
+SNAPSHOT_FORMAT = 2
+_SNAPSHOT_HEADER = struct.Struct("<4sHIdIHHH")  # magic, формат, число валют, время сохранения, crc32, длины строк
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, eq=False)
+class RateSnapshot:
+    currencies: list
+    rates: dict
+    date: str | None = None
+    previous_date: str | None = None
+    fetched_at: float = field(default_factory=time.monotonic)
+    version: int = 0
+    provider: str | None = None  # какой источник отдал снимок
+    restored: bool = False  # загружен с диска, а не из источника
+    # code -> (Value, Nominal) как в ответе ЦБ; rates — их частное, а точный режим
+    # конвертации делит их сам, без двоичной погрешности float
+    published: dict = field(default_factory=dict, repr=False)
+    # Матрица кросс-курсов: matrix[index[a], index[b]] — сколько b стоит одна единица a
+    index: dict = field(init=False, repr=False)
+    matrix: np.ndarray = field(init=False, repr=False)
+
+    def __post_init__(self):
+        codes = list(self.rates)
+        values = np.fromiter((self.rates[code] for code in codes), dtype=np.float64, count=len(codes))
+        object.__setattr__(self, "index", {code: i for i, code in enumerate(codes)})
+        object.__setattr__(self, "matrix", values[:, None] / values[None, :])
+
+    @classmethod
+    def from_cbr(cls, data: dict, version: int = 0, provider: str | None = None) -> "RateSnapshot":
+        currencies = list(data["Valute"].keys())
+        currencies.append("RUB")
+        rates = {"RUB": 1.0}
+        published = {}
+        for code, details in data["Valute"].items():
+            rates[code] = details["Value"] / details["Nominal"]
+            published[code] = (details["Value"], details["Nominal"])
+        return cls(
+            currencies=currencies,
+            rates=rates,
+            published=published,
+            date=data.get("Date"),
+            previous_date=data.get("PreviousDate"),
+            version=version,
+            provider=provider,
+        )
+
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+    def is_stale(self, max_age: float = RATES_STALE_AFTER) -> bool:
+        return self.age() > max_age
+
+    def cross_rate(self, source: str, target: str) -> float:
+        return float(self.matrix[self.index[source], self.index[target]])
+
+    def convert_many(self, amount: float, source: str, targets) -> np.ndarray:
+        # Одна сумма сразу во все целевые валюты
+        columns = [self.index[code] for code in targets]
+        return amount * self.matrix[self.index[source], columns]
+
+
+def _pad8(size: int) -> int:
+    return (8 - size % 8) % 8
+
+
+def save_snapshot(snapshot: RateSnapshot, path: str = RATES_SNAPSHOT_FILE):
+    # Пишем во временный файл и переименовываем: читатель видит либо старый снимок, либо новый целиком
+    codes = np.array([code.encode() for code in snapshot.currencies], dtype="S8")
+    published = [snapshot.published.get(code, (snapshot.rates[code], 1)) for code in snapshot.currencies]
+    values = np.array([value for value, _ in published], dtype=np.float64)
+    nominals = np.array([nominal for _, nominal in published], dtype=np.uint32)
+    strings = [(value or "").encode() for value in (snapshot.date, snapshot.previous_date, snapshot.provider)]
+    head = b"".join(strings)
+    body = head + b"\0" * _pad8(_SNAPSHOT_HEADER.size + len(head)) + codes.tobytes() + values.tobytes() + nominals.tobytes()
+    saved_at = time.time() - snapshot.age()
+    header = _SNAPSHOT_HEADER.pack(
+        SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, len(codes), saved_at, zlib.crc32(body), *(len(value) for value in strings)
+    )
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(body)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path: str = RATES_SNAPSHOT_FILE) -> RateSnapshot | None:
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, fmt, count, saved_at, crc, *lengths = _SNAPSHOT_HEADER.unpack_from(data)
+            if magic != SNAPSHOT_MAGIC or fmt != SNAPSHOT_FORMAT:
+                raise ValueError("неизвестный формат файла")
+            if zlib.crc32(memoryview(data)[_SNAPSHOT_HEADER.size:]) != crc:
+                raise ValueError("контрольная сумма не совпала")
+
+            offset = _SNAPSHOT_HEADER.size
+            strings = []
+            for length in lengths:
+                strings.append(data[offset:offset + length].decode() or None)
+                offset += length
+            offset += _pad8(offset)
+            codes = np.frombuffer(data, dtype="S8", count=count, offset=offset)
+            values = np.frombuffer(data, dtype=np.float64, count=count, offset=offset + count * 8)
+            nominals = np.frombuffer(data, dtype=np.uint32, count=count, offset=offset + count * 16)
+            currencies = [code.decode() for code in codes.tolist()]
+            published = dict(zip(currencies, zip(values.tolist(), nominals.tolist())))
+            del codes, values, nominals  # отпускаем буфер до закрытия mmap
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, struct.error) as e:
+        logger.warning("Не удалось прочитать сохранённый снимок курсов %s: %r", path, e)
+        return None
+
+    date, previous_date, provider = strings
+    return RateSnapshot(
+        currencies=currencies,
+        # То же деление, что в from_cbr: курсы совпадают с исходным снимком до бита
+        rates={code: value / nominal for code, (value, nominal) in published.items()},
+        published={code: pair for code, pair in published.items() if code != "RUB"},
+        date=date,
+        previous_date=previous_date,
+        # Возраст снимка переносим на монотонные часы этого процесса
+        fetched_at=time.monotonic() - max(0.0, time.time() - saved_at),
+        provider=provider,
+        restored=True,
+    )
+
+
+class RatesCache:
+    # Один снимок курсов на процесс. Обработчики сразу получают последний удачный
+    # снимок, а обновление выполняется одним запросом, сколько бы его ни ждало.
+
+    def __init__(self, source: HedgedRateSource, ttl: float = RATES_TTL,
+                 snapshot_file: str | None = RATES_SNAPSHOT_FILE):
+        self.source = source
+        self.ttl = ttl
+        self.snapshot_file = snapshot_file
+        self._snapshot: RateSnapshot | None = None
+        self._previous: RateSnapshot | None = None
+        self._refresh_task: asyncio.Task | None = None
+        self._version = 0
+        self._last_failure = 0.0
+        self._listeners = []
+
+    def add_listener(self, callback):
+        # callback(snapshot) вызывается после загрузки каждого нового снимка
+        self._listeners.append(callback)
+
+    @property
+    def snapshot(self) -> RateSnapshot | None:
+        return self._snapshot
+
+    @property
+    def previous_snapshot(self) -> RateSnapshot | None:
+        # Снимок до последнего обновления (в том числе восстановленный с диска)
+        return self._previous
+
+    def restore(self) -> RateSnapshot | None:
+        # Снимок с диска отдаётся сразу; слушателей не зовём — они видели его в прошлом запуске
+        if self._snapshot is None and self.snapshot_file:
+            snapshot = load_snapshot(self.snapshot_file)
+            if snapshot is not None and self._snapshot is None:
+                self._snapshot = snapshot
+                logger.info(
+                    "Курсы восстановлены с диска: публикация %s, возраст %.0f с", snapshot.date, snapshot.age()
+                )
+        return self._snapshot
+
+    async def get(self) -> RateSnapshot:
+        snapshot = self._snapshot or self.restore()
+        if snapshot is None:
+            # Отдавать пока нечего — ждём первый снимок
+            return await self.refresh()
+        if snapshot.age() > self.ttl and time.monotonic() - self._last_failure > RATES_RETRY_INTERVAL:
+            self._start_refresh()
+        return snapshot
+
+    async def refresh(self) -> RateSnapshot:
+        # shield: отмена одного из ожидающих не должна отменять общий запрос
+        return await asyncio.shield(self._start_refresh())
+
+    def _start_refresh(self) -> asyncio.Task:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._do_refresh())
+            self._refresh_task.add_done_callback(self._on_refresh_done)
+        return self._refresh_task
+
+    def _on_refresh_done(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            self._last_failure = time.monotonic()
+            RATE_FETCH_ERRORS.inc()
+            logger.warning("Не удалось обновить курсы: %r", task.exception())
+
+    async def _do_refresh(self) -> RateSnapshot:
+        started = time.perf_counter()
+        data, provider = await self.source.fetch()
+        RATE_FETCH_SECONDS.labels(provider).observe(time.perf_counter() - started)
+        self._version += 1
+        self._previous = self._snapshot
+        self._snapshot = RateSnapshot.from_cbr(data, version=self._version, provider=provider)
+        logger.info("Курсы обновлены из %s (публикация %s)", provider, self._snapshot.date)
+        snapshot = self._snapshot
+        for callback in self._listeners:
+            try:
+                callback(snapshot)
+            except Exception:
+                logger.exception("Ошибка в обработчике нового снимка курсов")
+        if self.snapshot_file:
+            try:
+                await asyncio.to_thread(save_snapshot, snapshot, self.snapshot_file)
+            except Exception as e:
+                logger.warning("Не удалось сохранить снимок курсов на диск: %r", e)
+        return snapshot
+
+    async def close(self):
+        if self._refresh_task is not None and not self._refresh_task.done():
+            self._refresh_task.cancel()
+        await self.source.close()
+
+
+rates_cache = RatesCache(HedgedRateSource(default_providers()))
@@ -0,0 +1,192 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import DeleteMessage, EditMessageText, SendMessage, TelegramMethod
+
+from ratelimit import TokenBucket, KeyedTokenBuckets
+
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))  # лимит Telegram ~30 сообщений/с
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))  # ~1 сообщение/с в один чат
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "3"))  # короткие всплески нажатий
+SENDER_WORKERS = int(os.getenv("SENDER_WORKERS", "8"))
+SENDER_MAX_RETRIES = int(os.getenv("SENDER_MAX_RETRIES", "3"))
+
+# Приоритеты: чем меньше число, тем раньше уходит запрос
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Job:
+    chat_id: int | None
+    method: TelegramMethod
+    priority: int
+    future: asyncio.Future
+    attempts: int = 0
+    created_at: float = field(default_factory=time.monotonic)
+
+
+class SendScheduler:
+    # Единая очередь исходящих запросов к Telegram: общий token bucket на бота,
+    # отдельные bucket'ы на каждый чат, учёт retry_after и приоритет интерактивных правок.
+
+    def __init__(
+        self,
+        global_rate: float = TELEGRAM_GLOBAL_RATE,
+        chat_rate: float = TELEGRAM_CHAT_RATE,
+        chat_burst: float = TELEGRAM_CHAT_BURST,
+        workers: int = SENDER_WORKERS,
+        max_retries: int = SENDER_MAX_RETRIES,
+    ):
+        self.bot: Bot | None = None
+        self.workers = workers
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate)
+        self._chats = KeyedTokenBuckets(chat_rate, chat_burst)
+        self._queue: asyncio.PriorityQueue | None = None
+        self._seq = itertools.count()
+        self._tasks: list[asyncio.Task] = []
+        self._paused_until = 0.0
+        self._depth = {priority: 0 for priority in PRIORITY_NAMES}
+        self.stats = {"sent": 0, "failed": 0, "retried": 0, "flood_waits": 0, "not_modified": 0}
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def queue_depth(self) -> dict:
+        return {PRIORITY_NAMES[priority]: depth for priority, depth in self._depth.items()}
+
+    def metrics(self) -> dict:
+        return {**self.stats, **{f"queue_{name}": depth for name, depth in self.queue_depth().items()}}
+
+    def submit(self, chat_id: int | None, method: TelegramMethod, priority: int = INTERACTIVE) -> asyncio.Future:
+        if self._queue is None:
+            raise RuntimeError("SendScheduler не запущен")
+        job = _Job(chat_id, method, priority, asyncio.get_running_loop().create_future())
+        self._put(job)
+        return job.future
+
+    async def call(self, chat_id: int | None, method: TelegramMethod, priority: int = INTERACTIVE):
+        return await self.submit(chat_id, method, priority)
+
+    async def send_message(self, chat_id: int, text: str, reply_markup=None, priority: int = INTERACTIVE):
+        return await self.call(chat_id, SendMessage(chat_id=chat_id, text=text, reply_markup=reply_markup), priority)
+
+    async def edit_message_text(self, chat_id: int, message_id: int, text: str, reply_markup=None,
+                                priority: int = INTERACTIVE):
+        method = EditMessageText(chat_id=chat_id, message_id=message_id, text=text, reply_markup=reply_markup)
+        return await self.call(chat_id, method, priority)
+
+    async def delete_message(self, chat_id: int, message_id: int, priority: int = INTERACTIVE):
+        return await self.call(chat_id, DeleteMessage(chat_id=chat_id, message_id=message_id), priority)
+
+    def delete_message_nowait(self, chat_id: int, message_id: int, priority: int = BACKGROUND):
+        # Удаление без ожидания результата: обработчик не держит слот ради него
+        future = self.submit(chat_id, DeleteMessage(chat_id=chat_id, message_id=message_id), priority)
+        future.add_done_callback(_log_delete_failure)
+
+    def _put(self, job: _Job):
+        self._depth[job.priority] += 1
+        self._queue.put_nowait((job.priority, next(self._seq), job))
+
+    def _defer(self, job: _Job, delay: float):
+        # Возвращаем задачу в очередь позже, не занимая воркер ожиданием
+        self._depth[job.priority] += 1
+        asyncio.get_running_loop().call_later(
+            delay, self._queue.put_nowait, (job.priority, next(self._seq), job)
+        )
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self._queue.get()
+            self._depth[job.priority] -= 1
+            if job.future.done():
+                # Тот, кто ждал ответа, уже отменил запрос
+                continue
+
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                self._defer(job, pause)
+                continue
+
+            if isinstance(job.method, DeleteMessage):
+                # Удаление не показывает пользователю ничего нового: лимит чата остаётся правкам
+                await self._global.acquire()
+                await self._execute(job)
+                continue
+
+            chat_bucket = self._chats.get(job.chat_id)
+            chat_delay = chat_bucket.delay()
+            if chat_delay > 0:
+                self._defer(job, chat_delay)
+                continue
+
+            await self._global.acquire()
+            if not chat_bucket.try_take():
+                # Пока ждали общий лимит, токен чата успел забрать другой воркер
+                self._defer(job, chat_bucket.delay())
+                continue
+
+            await self._execute(job)
+
+    async def _execute(self, job: _Job):
+        try:
+            result = await self.bot(job.method)
+        except TelegramRetryAfter as e:
+            self.stats["flood_waits"] += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            logger.warning("Flood control: пауза %s с (чат %s)", e.retry_after, job.chat_id)
+            self._retry(job, e, e.retry_after)
+        except TelegramBadRequest as e:
+            if "message is not modified" in e.message:
+                self.stats["not_modified"] += 1
+                self._resolve(job, None)
+            else:
+                self._fail(job, e)
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            self.stats["sent"] += 1
+            self._resolve(job, result)
+
+    def _resolve(self, job: _Job, result):
+        if not job.future.done():
+            job.future.set_result(result)
+
+    def _retry(self, job: _Job, error: Exception, delay: float):
+        job.attempts += 1
+        if job.attempts > self.max_retries:
+            self._fail(job, error)
+            return
+        self.stats["retried"] += 1
+        self._defer(job, delay)
+
+    def _fail(self, job: _Job, error: Exception):
+        self.stats["failed"] += 1
+        if not job.future.done():
+            job.future.set_exception(error)
+
+
+def _log_delete_failure(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.debug("Не удалось удалить сообщение: %r", future.exception())
+
+
+sender = SendScheduler()
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.types import Update
+
+from background import KeyedLanes
+from metrics import (
+    METRICS_PORT, SHARD_ACTIVE_USERS, SHARD_QUEUE, SHARD_THROUGHPUT, SHARD_UPDATES, mark_ready, start_metrics_server,
+)
+from webhook import run_webhook
+
+SHARD_STATS_INTERVAL = float(os.getenv("SHARD_STATS_INTERVAL", "30"))  # секунды
+SHARD_STOP_TIMEOUT = 30
+
+logger = logging.getLogger(__name__)
+
+
+def shard_for(user_id: int | None, workers: int) -> int:
+    return (user_id or 0) % workers
+
+
+class ShardRouter(BaseMiddleware):
+    # Внешний middleware фронт-процесса: вместо обработки отправляет апдейт
+    # воркеру, которому принадлежит пользователь
+
+    def __init__(self, queues: list):
+        self.queues = queues
+        self.routed = [0] * len(queues)
+
+    async def __call__(self, handler, event: Update, data: dict):
+        user = data.get("event_from_user")
+        user_id = user.id if user else None
+        index = shard_for(user_id, len(self.queues))
+        self.queues[index].put((user_id, event.model_dump(mode="json", exclude_none=True, by_alias=True)))
+        self.routed[index] += 1
+
+
+def _worker_entry(index: int, count: int, queue, stats_queue):
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_worker_main(index, count, queue, stats_queue))
+
+
+async def _worker_main(index: int, count: int, queue, stats_queue):
+    # У каждого воркера свои Bot, Dispatcher, кэши и пул соединений с БД
+    import main
+
+    loop = asyncio.get_running_loop()
+    shard = (index, count)
+    bot = main.get_bot()
+    lanes = KeyedLanes(lambda user_id, raw: main.dp.feed_raw_update(bot, raw))
+    tasks = await main.start_background_services(shard)
+    await main.warm_up(rates=main.prefetch_rates(), alerts=main.load_alerts(shard))
+    mark_ready()
+    reporter = asyncio.create_task(_report_worker_stats(index, lanes, stats_queue))
+    try:
+        while True:
+            item = await loop.run_in_executor(None, queue.get)
+            if item is None:
+                break
+            user_id, raw = item
+            lanes.submit(user_id, raw)
+        await lanes.join()
+    finally:
+        reporter.cancel()
+        await main.stop_background_services(tasks)
+        await bot.session.close()
+
+
+async def _report_worker_stats(index: int, lanes: KeyedLanes, stats_queue):
+    last_processed = 0
+    last_time = time.monotonic()
+    while True:
+        await asyncio.sleep(SHARD_STATS_INTERVAL)
+        now = time.monotonic()
+        stats_queue.put({
+            "worker": index,
+            "pid": os.getpid(),
+            "processed": lanes.processed,
+            "failed": lanes.failed,
+            "active_users": lanes.active(),
+            "pending": lanes.pending(),
+            "throughput": (lanes.processed - last_processed) / (now - last_time),
+        })
+        last_processed, last_time = lanes.processed, now
+
+
+async def _collect_stats(stats_queue, queues: list):
+    loop = asyncio.get_running_loop()
+    while True:
+        stats = await loop.run_in_executor(None, stats_queue.get)
+        if stats is None:
+            return
+        index = stats["worker"]
+        stats["queued"] = queues[index].qsize()
+        worker = str(index)
+        SHARD_UPDATES.labels(worker, "processed").set(stats["processed"])
+        SHARD_UPDATES.labels(worker, "failed").set(stats["failed"])
+        SHARD_QUEUE.labels(worker, "worker").set(stats["pending"])
+        SHARD_THROUGHPUT.labels(worker).set(stats["throughput"])
+        SHARD_ACTIVE_USERS.labels(worker).set(stats["active_users"])
+        logger.info(
+            "Воркер %d: %.1f апд./с, обработано %d (ошибок %d), в очереди %d, ждут в воркере %d",
+            index, stats["throughput"], stats["processed"], stats["failed"], stats["queued"], stats["pending"]
+        )
+
+
+async def run_sharded(bot: Bot, dp: Dispatcher, workers: int, mode: str = "polling"):
+    # spawn: воркеры не наследуют открытые соединения и event loop фронта
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(workers)]
+    stats_queue = ctx.Queue()
+    processes = [
+        ctx.Process(target=_worker_entry, args=(index, workers, queues[index], stats_queue), daemon=True)
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    router = ShardRouter(queues)
+    for index in range(workers):
+        # Очередь к воркеру и число разосланных апдейтов фронт знает сам, без отчётов
+        SHARD_UPDATES.labels(str(index), "routed").set_function(lambda index=index: router.routed[index])
+        SHARD_QUEUE.labels(str(index), "front").set_function(queues[index].qsize)
+    # Порт METRICS_PORT у фронта, воркеры — на следующих
+    metrics_runner = await start_metrics_server(METRICS_PORT)
+    front = Dispatcher()
+    front.update.outer_middleware(router)
+    collector = asyncio.create_task(_collect_stats(stats_queue, queues))
+    allowed_updates = dp.resolve_used_update_types()
+    # Как и в одном процессе, готовность — перед приёмом апдейтов: воркеры ещё могут
+    # прогреваться, но разосланные им апдейты дождутся их в очередях
+    mark_ready()
+    try:
+        if mode == "webhook":
+            await run_webhook(front, bot, allowed_updates)
+        else:
+            await bot.delete_webhook()
+            # Без задач на каждый апдейт: порядок попадания в очереди воркеров = порядок Telegram
+            await front.start_polling(bot, handle_as_tasks=False, allowed_updates=allowed_updates)
+    finally:
+        # Отпускаем поток, ждущий stats_queue, иначе loop не завершится
+        stats_queue.put(None)
+        await asyncio.gather(collector, return_exceptions=True)
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            process.join(SHARD_STOP_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
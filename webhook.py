@@ -0,0 +1,55 @@
+import asyncio
+import logging
+import os
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес балансировщика, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Регистрировать вебхук в Telegram при старте. Из нескольких реплик это достаточно делать одной.
+WEBHOOK_REGISTER = os.getenv("WEBHOOK_REGISTER", "1") == "1"
+
+logger = logging.getLogger(__name__)
+
+
+def build_webhook_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    app = web.Application()
+    # handle_in_background: Telegram сразу получает 200, обработка идёт в фоне.
+    # Запросы без правильного X-Telegram-Bot-Api-Secret-Token отклоняются с 401.
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=WEBHOOK_SECRET,
+    ).register(app, path=WEBHOOK_PATH)
+    return app
+
+
+async def register_webhook(dp: Dispatcher, bot: Bot, allowed_updates: list[str] | None = None):
+    if not WEBHOOK_URL:
+        raise RuntimeError("Для режима webhook нужно задать WEBHOOK_URL")
+    await bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=allowed_updates if allowed_updates is not None else dp.resolve_used_update_types(),
+    )
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, allowed_updates: list[str] | None = None):
+    if WEBHOOK_REGISTER:
+        await register_webhook(dp, bot, allowed_updates)
+
+    runner = web.AppRunner(build_webhook_app(dp, bot))
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logger.info("Вебхук слушает %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()